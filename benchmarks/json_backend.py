@@ -0,0 +1,94 @@
+"""
+Load throughput of the static json files and export throughput of
+FinalBookCharDataset.export_to_jsonl with every installed json backend of
+lib.common_util. The exports of all backends are checked to be
+byte-identical.
+
+$ python benchmarks/json_backend.py [--num_books 1708] [--chars_per_book 6]
+"""
+from __future__ import annotations
+
+import argparse
+import filecmp
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from lib import common_util
+from lib.book_char_dataset import FinalBookCharDataset
+from lib.common_util import read_json, set_json_backend
+from lib.database_util import BookInfo, CharacterInfoWithMaskedDescription
+
+STATIC_DIR = os.path.join(os.path.dirname(__file__), '..', 'static')
+STATIC_FILENAMES = [
+    'masked_description_changes.json',
+    'old_char_key_to_new_char_key_mapping.json',
+    'list_char_keys.json',
+]
+
+
+def generate_dataset(num_books, chars_per_book):
+    # mostly ASCII text, with some non-ASCII and control characters
+    books = []
+    characters = []
+    for i in range(num_books):
+        title = f'Book {i}' if i % 10 else f'Bücher {i}'
+        summary = ' '.join([f'"Summary"\tof book {i}.'] * 500)
+        books.append(BookInfo(title, 'sparknotes', summary))
+        for j in range(chars_per_book):
+            description = ' '.join([f'Character {j} of book {i}.'] * 50)
+            characters.append(CharacterInfoWithMaskedDescription(
+                character_name=f'Character {j}',
+                book_title=title,
+                source='sparknotes',
+                description=description,
+                masked_description=description.replace('Character', '[MASK]'),
+            ))
+    return FinalBookCharDataset(books, characters)
+
+def measure_load():
+    num_bytes = 0
+    start = time.perf_counter()
+    for filename in STATIC_FILENAMES:
+        path = os.path.join(STATIC_DIR, filename)
+        read_json(path)
+        num_bytes += os.path.getsize(path)
+    return num_bytes / (time.perf_counter() - start)
+
+def measure_export(dataset, filename):
+    start = time.perf_counter()
+    dataset.export_to_jsonl(filename)
+    return os.path.getsize(filename) / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--num_books', type=int, default=1708)
+    parser.add_argument('--chars_per_book', type=int, default=6)
+    args = parser.parse_args()
+
+    backends = ['stdlib']
+    if common_util.orjson is not None:
+        backends.append('orjson')
+
+    dataset = generate_dataset(args.num_books, args.chars_per_book)
+    with tempfile.TemporaryDirectory() as dirname:
+        filenames = []
+        for backend in backends:
+            set_json_backend(backend)
+            filename = os.path.join(dirname, f'{backend}.jsonl')
+            load_throughput = measure_load()
+            export_throughput = measure_export(dataset, filename)
+            print(
+                f'{backend:>8}: load {load_throughput / 2**20:6.1f} MiB/s, '
+                f'export {export_throughput / 2**20:6.1f} MiB/s'
+            )
+            filenames.append(filename)
+        for filename in filenames[1:]:
+            if not filecmp.cmp(filenames[0], filename, shallow=False):
+                raise AssertionError('the exports are not identical')
+
+if __name__ == '__main__':
+    main()
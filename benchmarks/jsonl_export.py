@@ -0,0 +1,85 @@
+"""
+Time and peak memory of FinalBookCharDataset.export_to_jsonl on synthetic
+books with many characters each, against building a list of dicts for
+write_jsonl as the export used to do. Both outputs are checked to be
+byte-identical.
+
+$ python benchmarks/jsonl_export.py [--num_books 200] [--chars_per_book 50]
+"""
+from __future__ import annotations
+
+import argparse
+import filecmp
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from lib.book_char_dataset import FinalBookCharDataset
+from lib.common_util import write_jsonl
+from lib.database_util import BookInfo, CharacterInfoWithMaskedDescription
+
+
+def generate_dataset(num_books, chars_per_book, summary_length):
+    books = []
+    characters = []
+    for i in range(num_books):
+        title = f'Book {i}'
+        summary = ' '.join(['summary'] * (summary_length // 8))
+        books.append(BookInfo(title, 'sparknotes', summary))
+        for j in range(chars_per_book):
+            characters.append(CharacterInfoWithMaskedDescription(
+                character_name=f'Character {j}',
+                book_title=title,
+                source='sparknotes',
+                description=f'description {j} of book {i}',
+                masked_description=f'description {j} of book {i}',
+            ))
+    return FinalBookCharDataset(books, characters)
+
+def export_with_dicts(dataset, filename):
+    book_char_data = []
+    for char_info in dataset.char_lookup.values():
+        book_info = dataset.book_lookup[char_info.book_key]
+        book_char_data.append(dataset.to_record(book_info, char_info))
+    write_jsonl(filename, book_char_data)
+
+def measure(name, export, dataset, filename):
+    start = time.perf_counter()
+    export(dataset, filename)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    export(dataset, filename)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{name:>8}: {elapsed:.2f} s, peak {peak / 2**20:7.1f} MiB')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--num_books', type=int, default=200)
+    parser.add_argument('--chars_per_book', type=int, default=50)
+    parser.add_argument('--summary_length', type=int, default=20000)
+    args = parser.parse_args()
+
+    dataset = generate_dataset(
+        args.num_books, args.chars_per_book, args.summary_length,
+    )
+    with tempfile.TemporaryDirectory() as dirname:
+        dict_filename = os.path.join(dirname, 'dicts.jsonl')
+        stream_filename = os.path.join(dirname, 'stream.jsonl')
+        measure('dicts', export_with_dicts, dataset, dict_filename)
+        measure(
+            'stream',
+            FinalBookCharDataset.export_to_jsonl,
+            dataset,
+            stream_filename,
+        )
+        if not filecmp.cmp(dict_filename, stream_filename, shallow=False):
+            raise AssertionError('the outputs are not identical')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Retained memory and export size of FinalBookCharDataset with masked
+descriptions and with mask spans, on synthetic descriptions masked by the
+changes in static/masked_description_changes.json. The masked descriptions
+of both are checked to be the same.
+
+$ python benchmarks/mask_spans.py [--tokens_per_description 200]
+"""
+from __future__ import annotations
+
+import argparse
+import ast
+import os
+import random
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from lib.book_char_dataset import FinalBookCharDataset
+from lib.common_util import read_json
+from lib.database_util import BookInfo, CharacterInfo
+from lib.database_util import CharacterInfoWithMaskedDescription
+from lib.database_util import CharacterInfoWithMaskSpans, interning
+from lib.text_diff_tool import TextDiffTool
+
+MASKED_DESCRIPTION_CHANGES_FILENAME = os.path.join(
+    os.path.dirname(__file__), '..', 'static',
+    'masked_description_changes.json',
+)
+WORDS = ['the', 'of', 'and', 'his', 'her', 'father', 'who', 'novel', 'later']
+
+
+def generate_characters(tokens_per_description):
+    # every description is long enough for all of its changes
+    rng = random.Random(0)
+    characters = []
+    for key, changes in read_json(MASKED_DESCRIPTION_CHANGES_FILENAME).items():
+        book_title, source, character_name = ast.literal_eval(key)
+        num_tokens = max(
+            [tokens_per_description] + [e for (_, e), _ in changes]
+        )
+        description = ' '.join(rng.choice(WORDS) for _ in range(num_tokens))
+        characters.append((
+            CharacterInfo(character_name, book_title, source, description),
+            changes,
+        ))
+    return characters
+
+@interning()
+def build(characters, mask_spans):
+    books = {}
+    final_characters = []
+    for char_info, changes in characters:
+        if char_info.book_key not in books:
+            books[char_info.book_key] = BookInfo(
+                *char_info.book_key, 'summary',
+            )
+        if mask_spans:
+            final_characters.append(
+                CharacterInfoWithMaskSpans
+                    .generate_from_char_info(char_info, changes)
+            )
+            continue
+        final_characters.append(
+            CharacterInfoWithMaskedDescription.generate_from_char_info(
+                char_info, ' '.join(TextDiffTool.restore_list_from_text(
+                    char_info.description, changes,
+                )),
+            )
+        )
+    return FinalBookCharDataset(list(books.values()), final_characters)
+
+def measure(name, characters, mask_spans, dirname):
+    tracemalloc.start()
+    dataset = build(characters, mask_spans)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    filename = os.path.join(dirname, f'{name}.jsonl')
+    dataset.export_to_jsonl(filename)
+    print(
+        f'{name:>20}: retained {current / 2**20:6.1f} MiB, '
+        f'export {os.path.getsize(filename) / 2**20:6.1f} MiB'
+    )
+    return dataset
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--tokens_per_description', type=int, default=200)
+    args = parser.parse_args()
+
+    characters = generate_characters(args.tokens_per_description)
+    with tempfile.TemporaryDirectory() as dirname:
+        masked = measure('masked_description', characters, False, dirname)
+        spans = measure('mask_spans', characters, True, dirname)
+    for char_key, char_info in masked.char_lookup.items():
+        if (
+            spans.char_lookup[char_key].masked_description
+            != char_info.masked_description
+        ):
+            raise AssertionError(f'different masked description {char_key}')
+
+if __name__ == '__main__':
+    main()
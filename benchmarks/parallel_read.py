@@ -0,0 +1,84 @@
+"""
+Scaling of read_jsonl and FinalBookCharDataset.load_from_jsonl with the
+number of worker processes, on an exported dataset file or on a synthetic
+one. The records read by every worker count are checked to be the same as
+the serial ones.
+
+$ python benchmarks/parallel_read.py [--filename liscu_all.jsonl] [--max_workers 8]
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from lib.book_char_dataset import FinalBookCharDataset
+from lib.common_util import read_jsonl
+from lib.database_util import BookInfo, CharacterInfoWithMaskedDescription
+
+
+def generate_file(filename, num_books, chars_per_book):
+    books = []
+    characters = []
+    for i in range(num_books):
+        title = f'Book {i}'
+        books.append(BookInfo(title, 'sparknotes', f'summary {i} ' * 2000))
+        for j in range(chars_per_book):
+            description = f'description {j} of book {i} ' * 100
+            characters.append(CharacterInfoWithMaskedDescription(
+                character_name=f'Character {j}',
+                book_title=title,
+                source='sparknotes',
+                description=description,
+                masked_description=description,
+            ))
+    FinalBookCharDataset(books, characters).export_to_jsonl(filename)
+
+def get_worker_counts(max_workers):
+    worker_counts = []
+    num_workers = 1
+    while num_workers < max_workers:
+        worker_counts.append(num_workers)
+        num_workers *= 2
+    return worker_counts + [max_workers]
+
+def measure(filename, max_workers):
+    expected = read_jsonl(filename)
+    for num_workers in get_worker_counts(max_workers):
+        start = time.perf_counter()
+        data = read_jsonl(filename, num_workers=num_workers)
+        read_elapsed = time.perf_counter() - start
+        if data != expected:
+            raise AssertionError(f'different records with {num_workers}')
+
+        start = time.perf_counter()
+        FinalBookCharDataset.load_from_jsonl(filename, num_workers=num_workers)
+        load_elapsed = time.perf_counter() - start
+        print(
+            f'{num_workers:>3} workers: read_jsonl {read_elapsed:.2f} s, '
+            f'load_from_jsonl {load_elapsed:.2f} s'
+        )
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--filename', type=str, default=None)
+    parser.add_argument('--max_workers', type=int, default=os.cpu_count())
+    parser.add_argument('--num_books', type=int, default=1708)
+    parser.add_argument('--chars_per_book', type=int, default=6)
+    args = parser.parse_args()
+
+    print(f'{os.cpu_count()} cores')
+    if args.filename is not None:
+        measure(args.filename, args.max_workers)
+        return
+    with tempfile.TemporaryDirectory() as dirname:
+        filename = os.path.join(dirname, 'liscu_all.jsonl')
+        generate_file(filename, args.num_books, args.chars_per_book)
+        measure(filename, args.max_workers)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""
+Peak memory of building BasicBookCharDataset and FinalBookCharDataset from
+synthetic records at a multiple of the corpus size, with the slotted records
+of lib.database_util and with plain dataclass records.
+
+$ python benchmarks/record_memory.py [--scale 10]
+"""
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Tuple
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from lib.book_char_dataset import BasicBookCharDataset, FinalBookCharDataset
+from lib.database_util import BookInfo, CharacterInfo
+from lib.database_util import CharacterInfoWithMaskedDescription, interning
+
+NUM_BOOKS = 1708 # books in the corpus
+NUM_CHARACTERS = 9499 # characters in the corpus
+SOURCES = ['shmoop', 'sparknotes', 'cliffnotes', 'litcharts']
+
+
+@dataclass
+class PlainBookInfo(object):
+    book_title: str
+    source: str
+    summary: str
+
+    @property
+    def book_key(self) -> Tuple[str, str]:
+        return (self.book_title, self.source)
+
+@dataclass
+class PlainCharacterInfo(object):
+    character_name: str
+    book_title: str
+    source: str
+    description: str
+
+    @property
+    def book_key(self) -> Tuple[str, str]:
+        return (self.book_title, self.source)
+
+    @property
+    def char_key(self) -> Tuple[str, str, str]:
+        return (self.book_title, self.source, self.character_name)
+
+@dataclass
+class PlainCharacterInfoWithMaskedDescription(object):
+    character_name: str
+    book_title: str
+    source: str
+    description: str
+    masked_description: str
+
+    @property
+    def book_key(self) -> Tuple[str, str]:
+        return (self.book_title, self.source)
+
+    @property
+    def char_key(self) -> Tuple[str, str, str]:
+        return (self.book_title, self.source, self.character_name)
+
+
+def generate_rows(scale):
+    # titles and sources are read from the database as separate strings for
+    # every row, so they are not shared here either
+    num_books = NUM_BOOKS * scale
+    num_characters = NUM_CHARACTERS * scale
+    book_rows = [
+        (f'Book {i}', ''.join(SOURCES[i % len(SOURCES)]), f'summary {i}')
+        for i in range(num_books)
+    ]
+    char_rows = []
+    for i in range(num_characters):
+        title, source, _ = book_rows[i % num_books]
+        char_rows.append((
+            f'Character {i}', ''.join(title), ''.join(source),
+            f'description {i}',
+        ))
+    return book_rows, char_rows
+
+@interning()
+def build(book_cls, char_cls, masked_cls, book_rows, char_rows):
+    # the records are built in one interning scope, as a loader builds them
+    dataset = BasicBookCharDataset(
+        [book_cls(*row) for row in book_rows],
+        [char_cls(*row) for row in char_rows],
+    )
+    dataset.replace_keys({}, {})
+    return FinalBookCharDataset(
+        books=list(dataset.book_lookup.values()),
+        characters=[
+            masked_cls(
+                character_name=c.character_name,
+                book_title=c.book_title,
+                source=c.source,
+                description=c.description,
+                masked_description=c.description,
+            )
+            for c in dataset.char_lookup.values()
+        ],
+    )
+
+def measure(name, classes, book_rows, char_rows):
+    # timed without tracemalloc, which slows down every allocation
+    start = time.perf_counter()
+    final_dataset = build(*classes, book_rows, char_rows)
+    elapsed = time.perf_counter() - start
+    del final_dataset
+
+    tracemalloc.start()
+    final_dataset = build(*classes, book_rows, char_rows)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        f'{name:>8}: retained {current / 2**20:7.1f} MiB, '
+        f'peak {peak / 2**20:7.1f} MiB, {elapsed:.2f} s '
+        f'({len(final_dataset.char_lookup)} characters)'
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--scale', type=int, default=10)
+    args = parser.parse_args()
+
+    book_rows, char_rows = generate_rows(args.scale)
+    measure('plain', (
+        PlainBookInfo, PlainCharacterInfo,
+        PlainCharacterInfoWithMaskedDescription,
+    ), book_rows, char_rows)
+    measure('slotted', (
+        BookInfo, CharacterInfo, CharacterInfoWithMaskedDescription,
+    ), book_rows, char_rows)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Loader startup with the token views of lib.token_offsets against
+splitting every summary, description and masked description on spaces, on
+an exported dataset file or on a synthetic one of the corpus size. The
+tokens of both are checked to be the same.
+
+$ python benchmarks/token_offsets.py [--filename liscu_all.jsonl]
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from lib.book_char_dataset import FinalBookCharDataset
+from lib.common_util import read_jsonl
+from lib.database_util import BookInfo, CharacterInfoWithMaskedDescription
+from lib.token_offsets import TOKEN_FIELDS, TokenOffsetReader
+
+WORDS = ['the', 'of', 'and', 'his', 'her', 'father', 'who', 'novel', 'later']
+
+
+def generate_file(filename, num_books, chars_per_book):
+    rng = random.Random(0)
+    def generate_text(num_tokens):
+        return ' '.join(rng.choice(WORDS) for _ in range(num_tokens))
+
+    books = []
+    characters = []
+    for i in range(num_books):
+        title = f'Book {i}'
+        books.append(BookInfo(title, 'sparknotes', generate_text(1500)))
+        for j in range(chars_per_book):
+            description = generate_text(200)
+            characters.append(CharacterInfoWithMaskedDescription(
+                character_name=f'Character {j}',
+                book_title=title,
+                source='sparknotes',
+                description=description,
+                masked_description=description.replace('his', '[MASK]'),
+            ))
+    FinalBookCharDataset(books, characters).export_to_jsonl_files(
+        filename, {}, token_offsets=True,
+    )
+
+def split_all(records):
+    return [
+        [record[field].split(' ') for field in TOKEN_FIELDS]
+        for record in records
+    ]
+
+def get_all_views(filename, records):
+    reader = TokenOffsetReader(filename)
+    return [
+        [reader.get_tokens(i, field, record[field]) for field in TOKEN_FIELDS]
+        for i, record in enumerate(records)
+    ]
+
+def measure(name, func, *args):
+    start = time.perf_counter()
+    func(*args)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    result = func(*args)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        f'{name:>12}: {elapsed:.3f} s, retained {current / 2**20:7.1f} MiB'
+    )
+    return result
+
+def run(filename):
+    records = read_jsonl(filename)
+    measure('open', TokenOffsetReader, filename)
+    views = measure('views', get_all_views, filename, records)
+    tokens = measure('split', split_all, records)
+
+    for i, (record_views, record_tokens) in enumerate(zip(views, tokens)):
+        for field, view, field_tokens in zip(
+            TOKEN_FIELDS, record_views, record_tokens,
+        ):
+            if list(view) != field_tokens:
+                raise AssertionError(f'different tokens of {field} of {i}')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--filename', type=str, default=None)
+    parser.add_argument('--num_books', type=int, default=1708)
+    parser.add_argument('--chars_per_book', type=int, default=6)
+    args = parser.parse_args()
+
+    if args.filename is not None:
+        run(args.filename)
+        return
+    with tempfile.TemporaryDirectory() as dirname:
+        filename = os.path.join(dirname, 'liscu_all.jsonl')
+        generate_file(filename, args.num_books, args.chars_per_book)
+        run(filename)
+
+if __name__ == '__main__':
+    main()
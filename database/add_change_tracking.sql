@@ -0,0 +1,38 @@
+-- adds the change tracking of create_tables.sql to a database created before
+-- it; rows that already exist count as changed by the first export
+ALTER TABLE literatures
+    ADD COLUMN IF NOT EXISTS row_version BIGINT,
+    ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ;
+
+ALTER TABLE characters
+    ADD COLUMN IF NOT EXISTS row_version BIGINT,
+    ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ;
+
+CREATE SEQUENCE IF NOT EXISTS row_version_seq;
+
+CREATE OR REPLACE FUNCTION bump_row_version() RETURNS trigger AS $$
+BEGIN
+    NEW.row_version := nextval('row_version_seq');
+    NEW.updated_at := now();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS literatures_row_version ON literatures;
+CREATE TRIGGER literatures_row_version
+    BEFORE INSERT OR UPDATE ON literatures
+    FOR EACH ROW EXECUTE PROCEDURE bump_row_version();
+
+DROP TRIGGER IF EXISTS characters_row_version ON characters;
+CREATE TRIGGER characters_row_version
+    BEFORE INSERT OR UPDATE ON characters
+    FOR EACH ROW EXECUTE PROCEDURE bump_row_version();
+
+-- the triggers set the row versions
+UPDATE literatures SET updated_at = now() WHERE row_version IS NULL;
+UPDATE characters SET updated_at = now() WHERE row_version IS NULL;
+
+CREATE INDEX IF NOT EXISTS literatures_row_version_idx
+    ON literatures (row_version);
+CREATE INDEX IF NOT EXISTS characters_row_version_idx
+    ON characters (row_version);
@@ -6,6 +6,8 @@ CREATE TABLE literatures (
     summary_url TEXT,
     summary_text TEXT,
     character_list_url TEXT,
+    row_version BIGINT,
+    updated_at TIMESTAMPTZ,
     PRIMARY KEY (book_title, source)
 );
 
@@ -19,8 +21,55 @@ CREATE TABLE characters (
     description_text TEXT,
     analysis_url TEXT,
     analysis_text TEXT,
+    row_version BIGINT,
+    updated_at TIMESTAMPTZ,
     PRIMARY KEY (character_name, book_title, source),
     FOREIGN KEY (book_title, source)
         REFERENCES literatures (book_title, source) MATCH SIMPLE
         ON UPDATE NO ACTION ON DELETE NO ACTION
-);
\ No newline at end of file
+);
+
+-- every inserted or updated row gets a new row_version, so the rows changed
+-- since an export are the ones with a greater row_version
+CREATE SEQUENCE row_version_seq;
+
+CREATE FUNCTION bump_row_version() RETURNS trigger AS $$
+BEGIN
+    NEW.row_version := nextval('row_version_seq');
+    NEW.updated_at := now();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER literatures_row_version
+    BEFORE INSERT OR UPDATE ON literatures
+    FOR EACH ROW EXECUTE PROCEDURE bump_row_version();
+
+CREATE TRIGGER characters_row_version
+    BEFORE INSERT OR UPDATE ON characters
+    FOR EACH ROW EXECUTE PROCEDURE bump_row_version();
+
+CREATE INDEX literatures_row_version_idx ON literatures (row_version);
+CREATE INDEX characters_row_version_idx ON characters (row_version);
+
+-- book x character pairs that are exported to the dataset; refreshed by the
+-- scraper pipeline whenever a spider finishes
+CREATE MATERIALIZED VIEW book_characters AS
+    SELECT
+        c.book_title,
+        c.source,
+        c.character_name,
+        l.summary_text,
+        c.description_text
+    FROM characters c
+    JOIN literatures l USING (book_title, source)
+    WHERE l.summary_text IS NOT NULL AND l.summary_text <> ''
+        AND c.description_text IS NOT NULL AND c.description_text <> ''
+        AND c.character_name <> 'Major'
+        AND c.character_name <> 'Minor'
+        AND c.character_name <> 'Major Characters'
+        AND c.character_name <> 'Minor Characters'
+    ORDER BY c.book_title, c.source, c.character_name;
+
+CREATE UNIQUE INDEX book_characters_key_idx
+    ON book_characters (book_title, source, character_name);
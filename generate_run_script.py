@@ -28,6 +28,72 @@ def get_args():
         '--skip_scraping', action='store_true',
         help='whether to run the scraping process',
     )
+    parser.add_argument(
+        '--snapshot', type=str, dest='snapshot_dir', default=None,
+        help='a snapshot directory to load instead of scraping',
+    )
+    parser.add_argument(
+        '--full_fidelity', action='store_true',
+        help='whether to also scrape fields unused by the dataset',
+    )
+    parser.add_argument(
+        '--canary_sample_size', type=int, default=0,
+        help='number of sampled urls per source to check before scraping',
+    )
+    parser.add_argument(
+        '--use_export_view', action='store_true',
+        help='whether to read the data from the book_characters view',
+    )
+    parser.add_argument(
+        '--streaming', action='store_true',
+        help='whether to build the dataset one record at a time',
+    )
+    parser.add_argument(
+        '--incremental', action='store_true',
+        help='whether to only update the records changed since the last run',
+    )
+    parser.add_argument(
+        '--sources', type=str, nargs='+', default=[],
+        help='only build the dataset from these sources',
+    )
+    parser.add_argument(
+        '--book_titles', type=str, nargs='+', default=[],
+        help='only build the dataset from these books',
+    )
+    parser.add_argument(
+        '--splits', type=str, nargs='+', default=[],
+        choices=['train', 'test', 'val'],
+        help='only build the dataset from these splits',
+    )
+    parser.add_argument(
+        '--compression', type=str, default=None, choices=['gzip', 'zstd'],
+        help='write every output as compressed shards with a manifest',
+    )
+    parser.add_argument(
+        '--num_shards', type=int, default=1,
+        help='number of compressed shards per output',
+    )
+    parser.add_argument(
+        '--columnar', action='store_true',
+        help='whether to also write a books table and a characters table',
+    )
+    parser.add_argument(
+        '--json_backend', type=str, default=None,
+        choices=['stdlib', 'orjson'],
+        help='the json library used to read and write json files',
+    )
+    parser.add_argument(
+        '--workers', type=int, default=1,
+        help='number of processes that restore and mask the texts',
+    )
+    parser.add_argument(
+        '--token_offsets', action='store_true',
+        help='whether to also write the token offsets of every output',
+    )
+    parser.add_argument(
+        '--mask_spans', action='store_true',
+        help='whether to write mask spans instead of masked descriptions',
+    )
     return parser.parse_args()
 
 def main():
@@ -38,6 +104,7 @@ def main():
         'user': args.user,
         'password': args.password,
         'dbname': args.dbname,
+        'use_export_view': str(args.use_export_view),
     }
 
     config['output'] = {
@@ -45,20 +112,74 @@ def main():
         'train_filename': os.path.join(args.output_dir, 'liscu_train.jsonl'),
         'test_filename': os.path.join(args.output_dir, 'liscu_test.jsonl'),
         'val_filename': os.path.join(args.output_dir, 'liscu_val.jsonl'),
+        'state_filename': os.path.join(args.output_dir, 'export_state.json'),
+        'compression': args.compression or '',
+        'num_shards': str(args.num_shards),
+        'token_offsets': str(args.token_offsets),
+        'mask_spans': str(args.mask_spans),
+        'columnar_dirname': (
+            os.path.join(args.output_dir, 'liscu_columnar')
+            if args.columnar else ''
+        ),
+    }
+    config['build'] = {
+        'streaming': str(args.streaming),
+        'incremental': str(args.incremental),
+        'json_backend': args.json_backend or '',
+        'workers': str(args.workers),
+    }
+    config['subset'] = {
+        'sources': '\n'.join(args.sources),
+        'book_titles': '\n'.join(args.book_titles),
+        'splits': '\n'.join(args.splits),
     }
     with open('runtime.ini', 'w') as config_f:
         config.write(config_f)
 
+    # fields that are never read when generating the dataset
+    skipped_fields = (
+        '' if args.full_fidelity else 'analysis_url,analysis_text'
+    )
+
+    create_database = (
+        f'export PGPASSWORD=\'{args.password}\'\n'
+        f'createdb -U {args.user} -h {args.host} {args.dbname}\n'
+        f'psql -U {args.user} -h {args.host} {args.dbname} '
+        f'-f database/create_tables.sql\n'
+    )
+
     with open('run.sh', 'w') as script_f:
-        if not args.skip_scraping:
+        if args.snapshot_dir is not None:
+            script_f.write(
+                create_database +
+                f'python snapshot.py import {args.snapshot_dir}\n'
+            )
+        elif not args.skip_scraping:
+            script_f.write(create_database + 'cd scraper\n')
+            if args.canary_sample_size > 0:
+                # a stale report must not pass a canary crawl that crashed,
+                # and the sampled rows must not reach the database
+                for spider, settings in (
+                    ('wayback_lit', ''),
+                    (
+                        'wayback_char',
+                        f' -s SKIPPED_ITEM_FIELDS={skipped_fields}',
+                    ),
+                ):
+                    report = (
+                        f'scraper/spiders/output/{spider}_canary_report.txt'
+                    )
+                    script_f.write(
+                        f'rm -f {report}\n'
+                        f'scrapy crawl {spider} '
+                        f'-s CANARY_SAMPLE_SIZE={args.canary_sample_size} '
+                        f"-s 'ITEM_PIPELINES={{}}'{settings}\n"
+                        f'grep -q "^PASSED" {report} || exit 1\n'
+                    )
             script_f.write(
-                f'export PGPASSWORD=\'{args.password}\'\n'
-                f'createdb -U {args.user} -h {args.host} {args.dbname}\n'
-                f'psql -U {args.user} -h {args.host} {args.dbname} '
-                f'-f database/create_tables.sql\n'
-                'cd scraper\n'
                 'scrapy crawl wayback_lit\n'
-                'scrapy crawl wayback_char\n'
+                f'scrapy crawl wayback_char '
+                f'-s SKIPPED_ITEM_FIELDS={skipped_fields}\n'
                 'cd ..\n'
             )
         script_f.write('python main.py')
@@ -1,16 +1,164 @@
 from __future__ import annotations
 
-from typing import Any, Dict, List, Set, Tuple
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set
+from typing import Tuple
+from dataclasses import dataclass, field
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import os
+import time
 
 from .database_util import CharacterInfoWithMaskedDescription, DatabaseConnection
+from .database_util import CharacterInfoWithMaskSpans, interning
 from .database_util import BookKey, CharKey
 from .database_util import BookInfo, CharacterInfo
-from .common_util import read_jsonl, write_jsonl
+from .common_util import iter_lines, json_dumps, json_loads, write_jsonl
+from .common_util import get_json_backend, set_json_backend
+from .common_util import map_line_ranges, read_line_range
+from .common_util import get_shard_sizes, write_jsonl_shards
+from .common_util import IndexedJsonlReader, get_index_filename, read_index
+from .common_util import write_index, write_indexed_lines
+from .columnar_util import read_tables, write_tables
+from .token_offsets import write_token_offsets
 from .text_diff_tool import IndRange, TextDiffTool
 
+_SUMMARY_FIELD = ', "summary": '
+
+def get_key_str(char_key: CharKey) -> str:
+    # the key of a character in the split key files
+    book_title, source, character_name = char_key
+    return f'{character_name}|{book_title}|{source}'
+
+def _filter_records(
+    lines: Iterable[str],
+    sources: Optional[Set[str]],
+    keys: Optional[Set[str]],
+    fields: Optional[List[str]],
+) -> Iterator[dict]:
+    # Every line starts with the book_title, source and character_name of
+    # its record, so only that prefix is decoded for the skipped records.
+    for line in lines:
+        if sources is not None or keys is not None:
+            head = json_loads(line[:line.index(_SUMMARY_FIELD)] + '}')
+            if sources is not None and head['source'] not in sources:
+                continue
+            if keys is not None and get_key_str((
+                head['book_title'], head['source'], head['character_name'],
+            )) not in keys:
+                continue
+        record = json_loads(line)
+        if fields is not None:
+            record = {field: record[field] for field in fields}
+        yield record
+
+def _read_records_range(
+    filename: str,
+    start: int,
+    end: int,
+    json_backend: str,
+    sources: Optional[Set[str]],
+    keys: Optional[Set[str]],
+    fields: Optional[List[str]],
+) -> List[dict]:
+    set_json_backend(json_backend)
+    return list(_filter_records(
+        read_line_range(filename, start, end), sources, keys, fields,
+    ))
+
+def iter_dataset_records(
+    filename: str,
+    sources: Optional[Iterable[str]] = None,
+    keys: Optional[Iterable[str]] = None,
+    fields: Optional[List[str]] = None,
+    num_workers: int = 1,
+) -> Iterator[dict]:
+    # Streams the records of an exported dataset file, only of the given
+    # sources or name|title|source keys, and only with the given fields.
+    # With more than one worker, the file is read in line ranges by a process
+    # pool, and the records of a range are kept until they are yielded.
+    source_set = None if sources is None else set(sources)
+    key_set = None if keys is None else set(keys)
+    if num_workers <= 1:
+        yield from _filter_records(
+            iter_lines(filename), source_set, key_set, fields,
+        )
+        return
+    yield from map_line_ranges(
+        _read_records_range, filename, num_workers,
+        get_json_backend(), source_set, key_set, fields,
+    )
+
+def normalize_character_name(character_name: str) -> str:
+    return ' '.join(character_name.casefold().split())
+
 class BookCharDataset(object):
-    book_lookup: Dict[BookKey, Any]
-    char_lookup: Dict[CharKey, Any]
+    # The secondary indexes and counters are built when they are first used,
+    # and dropped whenever book_lookup or char_lookup is replaced. Changing
+    # the lookups in place needs a call to invalidate_indexes.
+    _book_lookup: Dict[BookKey, Any]
+    _char_lookup: Dict[CharKey, Any]
+    _indexes: Dict[str, Any]
+
+    @property
+    def book_lookup(self) -> Dict[BookKey, Any]:
+        return self._book_lookup
+
+    @book_lookup.setter
+    def book_lookup(self, book_lookup: Dict[BookKey, Any]):
+        self._book_lookup = book_lookup
+        self.invalidate_indexes()
+
+    @property
+    def char_lookup(self) -> Dict[CharKey, Any]:
+        return self._char_lookup
+
+    @char_lookup.setter
+    def char_lookup(self, char_lookup: Dict[CharKey, Any]):
+        self._char_lookup = char_lookup
+        self.invalidate_indexes()
+
+    def invalidate_indexes(self):
+        self._indexes = {}
+
+    def _get_index(self, name: str, build: Callable[[], Any]) -> Any:
+        if name not in self._indexes:
+            self._indexes[name] = build()
+        return self._indexes[name]
+
+    def _group_keys(
+        self,
+        keys: Iterable[Tuple[str, ...]],
+        get_group: Callable[[Tuple[str, ...]], Any],
+    ) -> Dict[Any, List[Tuple[str, ...]]]:
+        groups: Dict[Any, List[Tuple[str, ...]]] = {}
+        for key in keys:
+            groups.setdefault(get_group(key), []).append(key)
+        return groups
+
+    @property
+    def book_keys_by_source(self) -> Dict[str, List[BookKey]]:
+        return self._get_index('book_keys_by_source', lambda: self._group_keys(
+            self.book_lookup.keys(), lambda book_key: book_key[1],
+        ))
+
+    @property
+    def book_keys_by_title(self) -> Dict[str, List[BookKey]]:
+        return self._get_index('book_keys_by_title', lambda: self._group_keys(
+            self.book_lookup.keys(), lambda book_key: book_key[0],
+        ))
+
+    @property
+    def char_keys_by_book(self) -> Dict[BookKey, List[CharKey]]:
+        return self._get_index('char_keys_by_book', lambda: self._group_keys(
+            self.char_lookup.keys(), lambda char_key: char_key[:2],
+        ))
+
+    @property
+    def char_keys_by_name(self) -> Dict[str, List[CharKey]]:
+        # by normalized character name, across books and sources
+        return self._get_index('char_keys_by_name', lambda: self._group_keys(
+            self.char_lookup.keys(),
+            lambda char_key: normalize_character_name(char_key[2]),
+        ))
 
     @property
     def num_books(self) -> int:
@@ -18,15 +166,68 @@ class BookCharDataset(object):
 
     @property
     def num_unique_books(self) -> int:
-        uniq_books: Set[str] = set()
-        for book_title, _ in self.book_lookup.keys():
-            uniq_books.add(book_title)
-        return len(uniq_books)
+        return len(self.book_keys_by_title)
 
     @property
     def num_characters(self) -> int:
         return len(self.char_lookup)
 
+    @property
+    def num_books_by_source(self) -> Dict[str, int]:
+        return self._get_index('num_books_by_source', lambda: {
+            source: len(book_keys)
+            for source, book_keys in self.book_keys_by_source.items()
+        })
+
+    @property
+    def num_characters_by_source(self) -> Dict[str, int]:
+        def count() -> Dict[str, int]:
+            counts: Dict[str, int] = {}
+            for _, source, _ in self.char_lookup.keys():
+                counts[source] = counts.get(source, 0) + 1
+            return counts
+        return self._get_index('num_characters_by_source', count)
+
+    def find_book_keys(
+        self,
+        source: Optional[str] = None,
+        book_title: Optional[str] = None,
+    ) -> List[BookKey]:
+        if book_title is not None:
+            book_keys = self.book_keys_by_title.get(book_title, [])
+        elif source is not None:
+            book_keys = self.book_keys_by_source.get(source, [])
+        else:
+            book_keys = list(self.book_lookup.keys())
+        return [
+            book_key for book_key in book_keys
+            if source is None or book_key[1] == source
+        ]
+
+    def find_char_keys(
+        self,
+        source: Optional[str] = None,
+        book_title: Optional[str] = None,
+        character_name: Optional[str] = None,
+    ) -> List[CharKey]:
+        # the character name is matched after normalization
+        if character_name is not None:
+            char_keys = self.char_keys_by_name.get(
+                normalize_character_name(character_name), [],
+            )
+            return [
+                char_key for char_key in char_keys
+                if (source is None or char_key[1] == source)
+                and (book_title is None or char_key[0] == book_title)
+            ]
+        if source is None and book_title is None:
+            return list(self.char_lookup.keys())
+        return [
+            char_key
+            for book_key in self.find_book_keys(source, book_title)
+            for char_key in self.char_keys_by_book.get(book_key, [])
+        ]
+
     def filter_by_char_keys(self, char_keys: List[CharKey]):
         book_keys: List[BookKey] = list(set([
             (title, source) for title, source, _ in char_keys
@@ -54,17 +255,53 @@ class BasicBookCharDataset(BookCharDataset):
         self.char_lookup = {char.char_key: char for char in characters}
     
     @classmethod
+    @interning()
     def load_from_database(
         cls,
         db_conn: DatabaseConnection,
+        book_keys: Optional[List[BookKey]] = None,
+        char_keys: Optional[List[CharKey]] = None,
+        from_view: bool = False,
     ) -> BasicBookCharDataset:
-        books = db_conn.read_book_info()
-        characters = db_conn.read_character_info()
+        if book_keys is not None and char_keys is not None:
+            books, characters = (
+                db_conn.read_book_and_character_info_by_keys(
+                    book_keys, char_keys, from_view=from_view,
+                )
+            )
+        elif from_view:
+            books, characters = (
+                db_conn.read_book_and_character_info_from_view()
+            )
+        else:
+            books, characters = db_conn.read_book_and_character_info()
         return cls(books, characters)
 
+    @staticmethod
+    def iter_records(
+        filename: str,
+        sources: Optional[Iterable[str]] = None,
+        keys: Optional[Iterable[str]] = None,
+        fields: Optional[List[str]] = None,
+        num_workers: int = 1,
+    ) -> Iterator[dict]:
+        return iter_dataset_records(
+            filename, sources, keys, fields, num_workers,
+        )
+
     @classmethod
-    def load_from_jsonl(cls, filename: str) -> BasicBookCharDataset:
-        data: List[dict] = read_jsonl(filename)
+    @interning()
+    def load_from_jsonl(
+        cls,
+        filename: str,
+        *,
+        sources: Optional[Iterable[str]] = None,
+        keys: Optional[Iterable[str]] = None,
+        num_workers: int = 1,
+    ) -> BasicBookCharDataset:
+        data = cls.iter_records(
+            filename, sources=sources, keys=keys, num_workers=num_workers,
+        )
         
         books: List[BookInfo] = []
         book_keys: Set[BookKey] = set()
@@ -102,6 +339,7 @@ class BasicBookCharDataset(BookCharDataset):
             })
         write_jsonl(filename, book_char_data)
 
+    @interning()
     def replace_keys(
         self,
         book_key_replacement: Dict[BookKey, BookKey],
@@ -112,8 +350,9 @@ class BasicBookCharDataset(BookCharDataset):
             new_book_key = book_key_replacement.get(
                 book_key, book_key
             )
-            book_info.book_title = new_book_key[0]
-            book_info.source = new_book_key[1]
+            if new_book_key != book_key:
+                book_info.book_title = new_book_key[0]
+                book_info.source = new_book_key[1]
             new_book_lookup[new_book_key] = book_info
 
         new_char_lookup: Dict[CharKey, CharacterInfo] = {}
@@ -121,9 +360,10 @@ class BasicBookCharDataset(BookCharDataset):
             new_char_key = char_key_replacement.get(
                 char_key, char_key
             )
-            char_info.book_title = new_char_key[0]
-            char_info.source = new_char_key[1]
-            char_info.character_name = new_char_key[2]
+            if new_char_key != char_key:
+                char_info.book_title = new_char_key[0]
+                char_info.source = new_char_key[1]
+                char_info.character_name = new_char_key[2]
             new_char_lookup[new_char_key] = char_info
 
         self.book_lookup = new_book_lookup
@@ -153,7 +393,7 @@ class BasicBookCharDataset(BookCharDataset):
 
 
 
-class FinalBookCharDataset(object):
+class FinalBookCharDataset(BookCharDataset):
     book_lookup: Dict[BookKey, BookInfo]
     char_lookup: Dict[CharKey, CharacterInfoWithMaskedDescription]
 
@@ -165,10 +405,52 @@ class FinalBookCharDataset(object):
         self.book_lookup = {book.book_key: book for book in books}
         self.char_lookup = {char.char_key: char for char in characters}
 
+    @staticmethod
+    def iter_records(
+        filename: str,
+        sources: Optional[Iterable[str]] = None,
+        keys: Optional[Iterable[str]] = None,
+        fields: Optional[List[str]] = None,
+        num_workers: int = 1,
+    ) -> Iterator[dict]:
+        return iter_dataset_records(
+            filename, sources, keys, fields, num_workers,
+        )
+
     @classmethod
-    def load_from_jsonl(cls, filename: str) -> FinalBookCharDataset:
-        data: List[dict] = read_jsonl(filename)
-        
+    @interning()
+    def load_from_jsonl(
+        cls,
+        filename: str,
+        *,
+        sources: Optional[Iterable[str]] = None,
+        keys: Optional[List[str]] = None,
+        num_workers: int = 1,
+    ) -> FinalBookCharDataset:
+        # With keys, only their records are decoded, through the index
+        # sidecar if there is one. Either way, the records are in file order,
+        # and a key that is not in the file raises a KeyError.
+        data: Iterable[dict]
+        if keys is None:
+            data = cls.iter_records(
+                filename, sources=sources, num_workers=num_workers,
+            )
+        elif os.path.exists(get_index_filename(filename)):
+            with IndexedJsonlReader(filename) as reader:
+                data = reader.get_many(reader.sort_keys(keys))
+        else:
+            data = list(cls.iter_records(
+                filename, keys=keys, num_workers=num_workers,
+            ))
+            found_keys = set(get_key_str((
+                d['book_title'], d['source'], d['character_name'],
+            )) for d in data)
+            for key in keys:
+                if key not in found_keys:
+                    raise KeyError(key)
+        if keys is not None and sources is not None:
+            data = [d for d in data if d['source'] in sources]
+
         books: List[BookInfo] = []
         book_keys: Set[BookKey] = set()
         characters: List[CharacterInfoWithMaskedDescription] = []
@@ -182,6 +464,15 @@ class FinalBookCharDataset(object):
                 ))
                 book_keys.add(book_key)
             
+            if 'mask_spans' in d:
+                characters.append(CharacterInfoWithMaskSpans(
+                    book_title=d['book_title'],
+                    source=d['source'],
+                    character_name=d['character_name'],
+                    description=d['description'],
+                    mask_spans=d['mask_spans'],
+                ))
+                continue
             characters.append(CharacterInfoWithMaskedDescription(
                 book_title=d['book_title'],
                 source=d['source'],
@@ -192,42 +483,432 @@ class FinalBookCharDataset(object):
         
         return cls(books, characters)
 
+    @classmethod
+    @interning()
+    def load_from_columnar(cls, dirname: str) -> FinalBookCharDataset:
+        # every book is built once, and its characters refer to it by its id
+        tables = read_tables(dirname)
+        books_table = tables['books']
+        books = [
+            BookInfo(book_title=book_title, source=source, summary=summary)
+            for book_title, source, summary in zip(
+                books_table['book_title'],
+                books_table['source'],
+                books_table['summary'],
+            )
+        ]
+        chars_table = tables['characters']
+        if 'mask_spans' in chars_table:
+            characters = [
+                CharacterInfoWithMaskSpans(
+                    character_name=character_name,
+                    book_title=books[book_id].book_title,
+                    source=books[book_id].source,
+                    description=description,
+                    mask_spans=json_loads(mask_spans),
+                )
+                for book_id, character_name, description, mask_spans in zip(
+                    chars_table['book_id'],
+                    chars_table['character_name'],
+                    chars_table['description'],
+                    chars_table['mask_spans'],
+                )
+            ]
+            return cls(books, characters)
+        characters = [
+            CharacterInfoWithMaskedDescription(
+                character_name=character_name,
+                book_title=books[book_id].book_title,
+                source=books[book_id].source,
+                description=description,
+                masked_description=masked_description,
+            )
+            for book_id, character_name, description, masked_description
+            in zip(
+                chars_table['book_id'],
+                chars_table['character_name'],
+                chars_table['description'],
+                chars_table['masked_description'],
+            )
+        ]
+        return cls(books, characters)
+
+    def export_to_columnar(self, dirname: str, format: Optional[str] = None):
+        # A books table, and a characters table that refers to the books by
+        # their row ids, so that every summary is stored once. Characters
+        # with mask spans keep them, as a json string column, instead of
+        # their masked descriptions, as the jsonl export does.
+        book_ids = {
+            book_key: book_id
+            for book_id, book_key in enumerate(self.book_lookup.keys())
+        }
+        books = list(self.book_lookup.values())
+        characters = list(self.char_lookup.values())
+        chars_table: Dict[str, List[Any]] = {
+            'book_id': [book_ids[c.book_key] for c in characters],
+            'character_name': [c.character_name for c in characters],
+            'description': [c.description for c in characters],
+        }
+        if len(characters) > 0 and all(
+            isinstance(c, CharacterInfoWithMaskSpans) for c in characters
+        ):
+            chars_table['mask_spans'] = [
+                json_dumps(c.mask_spans) for c in characters
+            ]
+        else:
+            chars_table['masked_description'] = [
+                c.masked_description for c in characters
+            ]
+        write_tables(dirname, {
+            'books': {
+                'book_title': [b.book_title for b in books],
+                'source': [b.source for b in books],
+                'summary': [b.summary for b in books],
+            },
+            'characters': chars_table,
+        }, format=format)
+
+    @staticmethod
+    def to_record(
+        book_info: BookInfo,
+        char_info: CharacterInfoWithMaskedDescription,
+    ) -> dict:
+        # a character with mask spans is written with its spans instead of
+        # its masked description
+        record = {
+            'book_title': book_info.book_title,
+            'source': book_info.source,
+            'character_name': char_info.character_name,
+            'summary': book_info.summary,
+            'description': char_info.description,
+        }
+        if isinstance(char_info, CharacterInfoWithMaskSpans):
+            record['mask_spans'] = char_info.mask_spans
+        else:
+            record['masked_description'] = char_info.masked_description
+        return record
+
+    def iter_keyed_pieces(
+        self,
+        char_infos: Iterable[CharacterInfoWithMaskedDescription],
+    ) -> Iterator[Tuple[str, Tuple[str, ...]]]:
+        # the pieces of a book are dropped after its last character
+        char_infos = list(char_infos)
+        last_positions = {
+            char_info.book_key: i for i, char_info in enumerate(char_infos)
+        }
+        encoder = JsonlRecordEncoder()
+        for i, char_info in enumerate(char_infos):
+            book_info = self.book_lookup[char_info.book_key]
+            yield (
+                get_key_str(char_info.char_key),
+                encoder.encode_pieces(book_info, char_info),
+            )
+            if last_positions[char_info.book_key] == i:
+                encoder.release_book(char_info.book_key)
+
     def export_to_jsonl(self, filename: str):
-        book_char_data = []
-        for char_info in self.char_lookup.values():
-            book_key = char_info.book_key
-            book_info = self.book_lookup[book_key]
-            book_char_data.append({
-                'book_title': book_info.book_title,
-                'source': book_info.source,
-                'character_name': char_info.character_name,
-                'summary': book_info.summary,
-                'description': char_info.description,
-                'masked_description': char_info.masked_description,
-            })
-        write_jsonl(filename, book_char_data)
-    
+        write_indexed_lines(
+            filename, self.iter_keyed_pieces(self.char_lookup.values()),
+        )
+
+    @staticmethod
+    def patch_jsonl(filename: str, records: List[dict]):
+        # every line starts with the book_title, source and character_name of
+        # its record, so the unchanged lines are copied without decoding them
+        new_lines: Dict[str, str] = {}
+        for record in records:
+            line = json_dumps(record)
+            new_lines[line[:line.index(_SUMMARY_FIELD)]] = line + '\n'
+
+        tmp_filename = filename + '.tmp'
+        lengths: List[int] = []
+        with open(filename) as in_f, open(tmp_filename, 'w+') as out_f:
+            for line in in_f:
+                prefix = line[:line.index(_SUMMARY_FIELD)]
+                line = new_lines.get(prefix, line)
+                out_f.write(line)
+                lengths.append(len(line.encode('utf-8')))
+        os.replace(tmp_filename, filename)
+
+        # the keys keep their lines, but the offsets after a patched line move
+        if os.path.exists(get_index_filename(filename)):
+            offsets = read_index(filename)
+            keys = sorted(offsets, key=lambda key: offsets[key][0])
+            write_index(filename, keys, lengths)
+
     def export_to_jsonl_with_selected_keys(
         self,
         filename: str,
         keys: List[str],
     ):
-        book_char_data = []
         char_info_lookup: Dict[str, CharacterInfoWithMaskedDescription] = {
-            f"{c.character_name}|{c.book_title}|{c.source}": c
-            for c in self.char_lookup.values()
+            get_key_str(c.char_key): c for c in self.char_lookup.values()
         }
-        for key in keys:
-            char_info = char_info_lookup[key]
-            book_key = char_info.book_key
-            book_info = self.book_lookup[book_key]
-            book_char_data.append({
-                'book_title': book_info.book_title,
-                'source': book_info.source,
-                'character_name': char_info.character_name,
-                'summary': book_info.summary,
-                'description': char_info.description,
-                'masked_description': char_info.masked_description,
-            })
-        write_jsonl(filename, book_char_data)
-        
\ No newline at end of file
+        write_indexed_lines(filename, self.iter_keyed_pieces(
+            char_info_lookup[key] for key in keys
+        ))
+
+    def export_to_jsonl_files(
+        self,
+        filename: str,
+        split_keys: Dict[str, List[str]],
+        compression: Optional[str] = None,
+        num_shards: int = 1,
+        token_offsets: bool = False,
+    ):
+        # Every record is encoded once, in one pass over the characters, and
+        # then the full output and the splits, each in the order of its keys,
+        # are written in parallel. A record is kept as its encoded pieces, so
+        # the summaries are not copied into every line. With a compression,
+        # every output is written as num_shards compressed shards instead.
+        # With token_offsets, every output also gets its token offsets.
+        all_pieces = list(self.iter_keyed_pieces(self.char_lookup.values()))
+        pieces_lookup: Dict[str, Tuple[str, ...]] = dict(all_pieces)
+
+        outputs = [(filename, all_pieces)]
+        for split_filename, keys in split_keys.items():
+            outputs.append(
+                (split_filename, [(key, pieces_lookup[key]) for key in keys])
+            )
+        with ThreadPoolExecutor(max_workers=len(outputs)) as executor:
+            futures = []
+            for output_filename, keyed_pieces in outputs:
+                if compression is None:
+                    futures.append(executor.submit(
+                        write_indexed_lines, output_filename, keyed_pieces,
+                    ))
+                    continue
+                shards = []
+                start = 0
+                for size in get_shard_sizes(len(keyed_pieces), num_shards):
+                    shards.append(
+                        ''.join(pieces)
+                        for _, pieces in keyed_pieces[start:start + size]
+                    )
+                    start += size
+                futures.append(executor.submit(
+                    write_jsonl_shards, output_filename, shards, compression,
+                ))
+            if token_offsets:
+                texts_lookup = {
+                    get_key_str(c.char_key): (
+                        self.book_lookup[c.book_key].summary,
+                        c.description,
+                        c.masked_description,
+                    )
+                    for c in self.char_lookup.values()
+                }
+                for output_filename, keyed_pieces in outputs:
+                    futures.append(executor.submit(
+                        write_token_offsets,
+                        output_filename,
+                        [texts_lookup[key] for key, _ in keyed_pieces],
+                    ))
+            for future in futures:
+                future.result()
+
+
+class JsonlRecordEncoder(object):
+    # Encodes the records of FinalBookCharDataset.to_record to the same lines
+    # as json.dumps, but from pieces: the encoded title, source and summary of
+    # a book are kept and shared by the lines of all of its characters.
+    def __init__(self):
+        self._book_pieces: Dict[BookKey, Tuple[str, str]] = {}
+
+    def _encode_book(self, book_info: BookInfo) -> Tuple[str, str]:
+        return (
+            '{"book_title": ' + json_dumps(book_info.book_title)
+            + ', "source": ' + json_dumps(book_info.source)
+            + ', "character_name": ',
+            _SUMMARY_FIELD + json_dumps(book_info.summary)
+            + ', "description": ',
+        )
+
+    def encode_pieces(
+        self,
+        book_info: BookInfo,
+        char_info: CharacterInfoWithMaskedDescription,
+    ) -> Tuple[str, str, str, str]:
+        book_pieces = self._book_pieces.get(book_info.book_key)
+        if book_pieces is None:
+            book_pieces = self._encode_book(book_info)
+            self._book_pieces[book_info.book_key] = book_pieces
+        if isinstance(char_info, CharacterInfoWithMaskSpans):
+            masking = ', "mask_spans": ' + json_dumps(char_info.mask_spans)
+        else:
+            masking = (
+                ', "masked_description": '
+                + json_dumps(char_info.masked_description)
+            )
+        return (
+            book_pieces[0],
+            json_dumps(char_info.character_name),
+            book_pieces[1],
+            json_dumps(char_info.description) + masking + '}\n',
+        )
+
+    def release_book(self, book_key: BookKey):
+        # the pieces of a book are kept until the caller releases them
+        self._book_pieces.pop(book_key, None)
+
+    def encode(
+        self,
+        book_info: BookInfo,
+        char_info: CharacterInfoWithMaskedDescription,
+    ) -> str:
+        return ''.join(self.encode_pieces(book_info, char_info))
+
+
+BookStage = Callable[[BookInfo], BookInfo]
+CharStage = Callable[[Any], Any]
+BookGroup = Tuple[BookInfo, List[Any]] # a book and its characters
+
+@dataclass
+class BookCharPipeline(object):
+    # Stages that are applied to every record in one pass. A stage takes a
+    # record and returns it, changed or replaced. Every book goes through the
+    # book stages once, and then its characters go through the character
+    # stages. With more than one worker, the books and their characters are
+    # split among worker processes, so the stages must be picklable.
+    book_stages: List[Tuple[str, BookStage]] = field(default_factory=list)
+    char_stages: List[Tuple[str, CharStage]] = field(default_factory=list)
+    timings: Dict[str, float] = field(default_factory=dict) # seconds per stage
+
+    def add_book_stage(self, name: str, stage: BookStage) -> BookCharPipeline:
+        self.book_stages.append((name, stage))
+        return self
+
+    def add_char_stage(self, name: str, stage: CharStage) -> BookCharPipeline:
+        self.char_stages.append((name, stage))
+        return self
+
+    def _time(self, name: str, start: float) -> float:
+        end = time.perf_counter()
+        self.timings[name] = self.timings.get(name, 0.0) + end - start
+        return end
+
+    def _add_timings(self, timings: Dict[str, float]):
+        for name, seconds in timings.items():
+            self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def run_groups(self, groups: List[BookGroup]) -> List[BookGroup]:
+        start = time.perf_counter()
+        results: List[BookGroup] = []
+        for book_info, char_infos in groups:
+            for name, stage in self.book_stages:
+                book_info = stage(book_info)
+                start = self._time(name, start)
+            new_char_infos = []
+            for char_info in char_infos:
+                for name, stage in self.char_stages:
+                    char_info = stage(char_info)
+                    start = self._time(name, start)
+                new_char_infos.append(char_info)
+            results.append((book_info, new_char_infos))
+        return results
+
+    @interning()
+    def run(
+        self,
+        dataset: BookCharDataset,
+        book_key_replacement: Dict[BookKey, BookKey],
+        char_key_replacement: Dict[CharKey, CharKey],
+        char_keys: List[CharKey],
+        num_workers: int = 1,
+    ) -> Tuple[List[BookInfo], List[Any]]:
+        # Translates the keys of the dataset, as replace_keys does, and runs
+        # the stages on the characters of char_keys and their books, as
+        # filter_by_char_keys keeps them. Returns the books, in the order of
+        # their first characters, and the characters in the order of
+        # char_keys, whatever the number of workers.
+        self.timings = {}
+        start = time.perf_counter()
+        book_lookup: Dict[BookKey, BookInfo] = {}
+        for book_key, book_info in dataset.book_lookup.items():
+            new_book_key = book_key_replacement.get(book_key, book_key)
+            if new_book_key != book_key:
+                book_info.book_title, book_info.source = new_book_key
+            book_lookup[new_book_key] = book_info
+        char_lookup: Dict[CharKey, Any] = {}
+        for char_key, char_info in dataset.char_lookup.items():
+            new_char_key = char_key_replacement.get(char_key, char_key)
+            if new_char_key != char_key:
+                (
+                    char_info.book_title,
+                    char_info.source,
+                    char_info.character_name,
+                ) = new_char_key
+            char_lookup[new_char_key] = char_info
+
+        # the characters of every book, with their output positions
+        char_keys = list(dict.fromkeys(char_keys))
+        positions: Dict[BookKey, List[int]] = {}
+        for position, char_key in enumerate(char_keys):
+            positions.setdefault(char_key[:2], []).append(position)
+        groups: List[BookGroup] = [
+            (
+                book_lookup[book_key],
+                [char_lookup[char_keys[i]] for i in book_positions],
+            )
+            for book_key, book_positions in positions.items()
+        ]
+        self._time('replace_keys', start)
+
+        if num_workers <= 1:
+            results = self.run_groups(groups)
+        else:
+            results = self._run_groups_in_processes(groups, num_workers)
+
+        characters: List[Any] = [None] * len(char_keys)
+        for book_positions, (_, char_infos) in zip(
+            positions.values(), results,
+        ):
+            for position, char_info in zip(book_positions, char_infos):
+                characters[position] = char_info
+        return [book_info for book_info, _ in results], characters
+
+    def _run_groups_in_processes(
+        self,
+        groups: List[BookGroup],
+        num_workers: int,
+    ) -> List[BookGroup]:
+        # Every worker gets the stages once, and a few contiguous chunks of
+        # books. The results are merged back in the order of the chunks, and
+        # the timings add up the time spent in every worker.
+        num_chunks = num_workers * 4
+        chunks = []
+        start = 0
+        for size in get_shard_sizes(len(groups), num_chunks):
+            chunks.append(groups[start:start + size])
+            start += size
+        results: List[BookGroup] = []
+        with ProcessPoolExecutor(
+            max_workers=num_workers,
+            initializer=_init_pipeline_worker,
+            initargs=(self,),
+        ) as executor:
+            for chunk_results, timings in executor.map(
+                _run_pipeline_chunk, chunks,
+            ):
+                results += chunk_results
+                self._add_timings(timings)
+        return results
+
+    def format_timings(self) -> str:
+        return '\n'.join(
+            f'{name}: {seconds:.3f}s' for name, seconds in self.timings.items()
+        )
+
+_worker_pipeline: Optional[BookCharPipeline] = None
+
+def _init_pipeline_worker(pipeline: BookCharPipeline):
+    global _worker_pipeline
+    _worker_pipeline = pipeline
+
+def _run_pipeline_chunk(
+    groups: List[BookGroup],
+) -> Tuple[List[BookGroup], Dict[str, float]]:
+    _worker_pipeline.timings = {}
+    results = _worker_pipeline.run_groups(groups)
+    return results, _worker_pipeline.timings
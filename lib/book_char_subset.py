@@ -0,0 +1,62 @@
+from __future__ import annotations
+
+from typing import Optional, Set
+from dataclasses import dataclass, field
+
+from .database_util import BookKey, CharKey
+
+@dataclass
+class BookCharSubset(object):
+    sources: Optional[Set[str]] = None # None keeps every source
+    book_titles: Optional[Set[str]] = None # None keeps every book
+    char_keys: Optional[Set[CharKey]] = field( # None keeps every character
+        default=None, repr=False,
+    )
+
+    _char_key_strs: Set[str] = field(
+        default_factory=set, init=False, repr=False,
+    )
+    _book_key_strs: Set[str] = field(
+        default_factory=set, init=False, repr=False,
+    )
+
+    def __post_init__(self):
+        if self.char_keys is not None:
+            self._char_key_strs = set(map(str, self.char_keys))
+            self._book_key_strs = set([
+                str((title, source)) for title, source, _ in self.char_keys
+            ])
+
+    def contains_book_key(self, book_key: BookKey) -> bool:
+        title, source = book_key
+        return (
+            (self.sources is None or source in self.sources)
+            and (self.book_titles is None or title in self.book_titles)
+            and (
+                self.char_keys is None
+                or str(book_key) in self._book_key_strs
+            )
+        )
+
+    def contains_char_key(self, char_key: CharKey) -> bool:
+        return (
+            self.contains_book_key(char_key[:2])
+            and (self.char_keys is None or char_key in self.char_keys)
+        )
+
+    def may_contain_key_str(self, key_str: str) -> bool:
+        # a cheap check on the str() of a book or char key, as used by the
+        # static files, that never rejects a key of the subset
+        if self.char_keys is not None and not (
+            key_str in self._char_key_strs or key_str in self._book_key_strs
+        ):
+            return False
+        if self.sources is not None and not any(
+            repr(source) in key_str for source in self.sources
+        ):
+            return False
+        if self.book_titles is not None and not any(
+            repr(title) in key_str for title in self.book_titles
+        ):
+            return False
+        return True
@@ -0,0 +1,133 @@
+from typing import Any, Dict, List, Optional
+import os
+
+import numpy as np
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from .common_util import read_json, write_json
+
+COLUMNAR_FORMAT_VERSION = 1
+COLUMNAR_FORMATS = ('parquet', 'numpy')
+MANIFEST_FILENAME = 'manifest.json'
+
+Table = Dict[str, List[Any]] # column name -> values, of str or int
+
+def get_default_format() -> str:
+    return 'parquet' if pyarrow is not None else 'numpy'
+
+def _get_column_type(values: List[Any]) -> str:
+    return 'int' if len(values) > 0 and isinstance(values[0], int) else 'str'
+
+def _write_numpy_column(path: str, values: List[Any], column_type: str):
+    # an int column is one array, and a str column is the utf-8 bytes of all
+    # values in one blob with the offsets of every value in another array
+    if column_type == 'int':
+        np.save(f'{path}.npy', np.array(values, dtype=np.int64))
+        return
+    encoded = [value.encode('utf-8') for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    np.save(f'{path}.offsets.npy', offsets)
+    np.save(f'{path}.blob.npy', np.frombuffer(b''.join(encoded), np.uint8))
+
+def _read_numpy_column(path: str, column_type: str) -> List[Any]:
+    if column_type == 'int':
+        return np.load(f'{path}.npy').tolist()
+    offsets = np.load(f'{path}.offsets.npy').tolist()
+    blob = np.load(f'{path}.blob.npy').tobytes()
+    return [
+        blob[start:end].decode('utf-8')
+        for start, end in zip(offsets[:-1], offsets[1:])
+    ]
+
+def write_tables(
+    dirname: str,
+    tables: Dict[str, Table],
+    format: Optional[str] = None,
+):
+    # Writes every table to dirname as Parquet, or as NumPy arrays when
+    # pyarrow is not installed, with a manifest of the tables and columns.
+    format = format or get_default_format()
+    if format not in COLUMNAR_FORMATS:
+        raise ValueError(f'unsupported columnar format {format}')
+    if format == 'parquet' and pyarrow is None:
+        raise ImportError('the parquet format requires pyarrow')
+
+    os.makedirs(dirname, exist_ok=True)
+    manifest_tables: Dict[str, Any] = {}
+    for table_name, table in tables.items():
+        columns = {
+            name: _get_column_type(values) for name, values in table.items()
+        }
+        num_rows = len(next(iter(table.values()), []))
+        if format == 'parquet':
+            pyarrow.parquet.write_table(
+                pyarrow.table({
+                    name: pyarrow.array(
+                        values,
+                        pyarrow.int64() if columns[name] == 'int'
+                        else pyarrow.string(),
+                    )
+                    for name, values in table.items()
+                }),
+                os.path.join(dirname, f'{table_name}.parquet'),
+            )
+        else:
+            for name, values in table.items():
+                _write_numpy_column(
+                    os.path.join(dirname, f'{table_name}.{name}'),
+                    values,
+                    columns[name],
+                )
+        manifest_tables[table_name] = {
+            'columns': columns,
+            'num_rows': num_rows,
+        }
+    write_json(os.path.join(dirname, MANIFEST_FILENAME), {
+        'format_version': COLUMNAR_FORMAT_VERSION,
+        'format': format,
+        'tables': manifest_tables,
+    })
+
+def read_tables(dirname: str) -> Dict[str, Table]:
+    manifest = read_json(os.path.join(dirname, MANIFEST_FILENAME))
+    if manifest['format_version'] != COLUMNAR_FORMAT_VERSION:
+        raise ValueError(
+            f'unsupported columnar format version '
+            f'{manifest["format_version"]}'
+        )
+    if manifest['format'] == 'parquet' and pyarrow is None:
+        raise ImportError('the parquet format requires pyarrow')
+
+    tables: Dict[str, Table] = {}
+    for table_name, table_info in manifest['tables'].items():
+        columns: Dict[str, str] = table_info['columns']
+        if manifest['format'] == 'parquet':
+            arrow_table = pyarrow.parquet.read_table(
+                os.path.join(dirname, f'{table_name}.parquet')
+            )
+            table = {
+                name: arrow_table.column(name).to_pylist()
+                for name in columns
+            }
+        else:
+            table = {
+                name: _read_numpy_column(
+                    os.path.join(dirname, f'{table_name}.{name}'),
+                    column_type,
+                )
+                for name, column_type in columns.items()
+            }
+        for name, values in table.items():
+            if len(values) != table_info['num_rows']:
+                raise ValueError(
+                    f'expect {table_info["num_rows"]} rows in '
+                    f'{table_name}.{name}, but read {len(values)}'
+                )
+        tables[table_name] = table
+    return tables
@@ -1,19 +1,371 @@
-from typing import List, Any
+from __future__ import annotations
 
+from typing import IO, Any, Dict, Iterable, Iterator, List, Optional, Sequence
+from typing import Callable, Tuple, Union
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+import gzip
+import hashlib
+import itertools
 import json
+import mmap
+import os
+import random
 
-def read_jsonl(filename: str) -> List[Any]:
-    data: List[Any] = []
-    with open(filename) as in_f:
-        for line in in_f.readlines():
-            data.append(json.loads(line))
-    return data
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+IO_BUFFER_SIZE = 1 << 20
+
+SHARD_FORMAT_VERSION = 1
+SHARD_EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+
+INDEX_FORMAT_VERSION = 1
+
+JSON_BACKENDS = ('stdlib', 'orjson')
+_json_backend = 'orjson' if orjson is not None else 'stdlib'
+
+def get_json_backend() -> str:
+    return _json_backend
+
+def set_json_backend(backend: str):
+    global _json_backend
+    if backend not in JSON_BACKENDS:
+        raise ValueError(f'unsupported json backend {backend}')
+    if backend == 'orjson' and orjson is None:
+        raise ImportError('the orjson json backend requires orjson')
+    _json_backend = backend
+
+def json_loads(data: Union[str, bytes]) -> Any:
+    if _json_backend == 'orjson':
+        return orjson.loads(data)
+    return json.loads(data)
+
+def json_dumps(data: Any) -> str:
+    # The output is always the one of json.dumps. orjson only encodes the
+    # strings it escapes the same way, i.e. the ASCII ones without DEL, since
+    # it neither escapes non-ASCII characters nor adds spaces between items.
+    if (
+        _json_backend == 'orjson' and type(data) is str
+        and data.isascii() and '\x7f' not in data
+    ):
+        return orjson.dumps(data).decode()
+    return json.dumps(data)
+
+def iter_lines(filename: str) -> Iterator[str]:
+    with open(filename, buffering=IO_BUFFER_SIZE) as in_f:
+        yield from in_f
+
+def split_line_ranges(
+    filename: str,
+    num_ranges: int,
+) -> List[Tuple[int, int]]:
+    # byte ranges of about the same size that start and end at line breaks
+    size = os.path.getsize(filename)
+    boundaries = [0]
+    with open(filename, 'rb') as in_f:
+        for i in range(1, num_ranges):
+            in_f.seek(max(i * size // num_ranges, boundaries[-1]))
+            in_f.readline()
+            boundaries.append(min(in_f.tell(), size))
+    boundaries.append(size)
+    return [
+        (start, end)
+        for start, end in zip(boundaries[:-1], boundaries[1:])
+        if start < end
+    ]
 
-def write_jsonl(filename: str, data: List[Any]):
+def read_line_range(filename: str, start: int, end: int) -> List[str]:
+    with open(filename, 'rb') as in_f:
+        in_f.seek(start)
+        lines = in_f.read(end - start).decode('utf-8').split('\n')
+    return [line for line in lines if line]
+
+def map_line_ranges(
+    func: Callable[..., List[Any]],
+    filename: str,
+    num_workers: int,
+    *args: Any,
+) -> Iterator[Any]:
+    # Calls func(filename, start, end, *args) on the line ranges of filename
+    # in a process pool, and yields the items of the results in file order.
+    # func and args must be picklable. There are a few ranges per worker, so
+    # that a slow range does not hold up the others.
+    ranges = split_line_ranges(filename, num_workers * 4)
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [
+            executor.submit(func, filename, start, end, *args)
+            for start, end in ranges
+        ]
+        for future in futures:
+            yield from future.result()
+
+def _read_jsonl_range(
+    filename: str,
+    start: int,
+    end: int,
+    json_backend: str,
+) -> List[Any]:
+    set_json_backend(json_backend)
+    return [json_loads(line) for line in read_line_range(filename, start, end)]
+
+def read_jsonl(filename: str, num_workers: int = 1) -> List[Any]:
+    # with more than one worker, the lines are decoded in a process pool
+    if num_workers <= 1:
+        return [json_loads(line) for line in iter_lines(filename)]
+    return list(map_line_ranges(
+        _read_jsonl_range, filename, num_workers, get_json_backend(),
+    ))
+
+def write_jsonl(filename: str, data: Iterable[Any]):
     with open(filename, 'w+') as out_f:
         for d in data:
-            out_f.write(json.dumps(d)+'\n')
+            out_f.write(json_dumps(d)+'\n')
 
 def read_json(filename: str) -> Any:
     with open(filename) as in_f:
-        return json.load(in_f)
\ No newline at end of file
+        return json_loads(in_f.read())
+
+def write_json(filename: str, data: Any):
+    # json.dump streams the chunks, where json_dumps would build the whole
+    # document, and json_dumps only speeds up bare strings anyway
+    with open(filename, 'w+') as out_f:
+        json.dump(data, out_f)
+
+def write_lines(filename: str, lines: Iterable[str]):
+    with open(filename, 'w+', buffering=IO_BUFFER_SIZE) as out_f:
+        out_f.writelines(lines)
+
+def _num_bytes(text: str) -> int:
+    return len(text) if text.isascii() else len(text.encode('utf-8'))
+
+def get_index_filename(filename: str) -> str:
+    return f'{os.path.splitext(filename)[0]}.index.json'
+
+def write_index(filename: str, keys: Iterable[str], lengths: Iterable[int]):
+    # the index sidecar of filename maps the key of every line, in order, to
+    # the byte offset and length of the line
+    offsets: Dict[str, Tuple[int, int]] = {}
+    offset = 0
+    for key, length in zip(keys, lengths):
+        offsets[key] = (offset, length)
+        offset += length
+    write_json(get_index_filename(filename), {
+        'format_version': INDEX_FORMAT_VERSION,
+        'offsets': offsets,
+    })
+
+def read_index(filename: str) -> Dict[str, Tuple[int, int]]:
+    index = read_json(get_index_filename(filename))
+    if index['format_version'] != INDEX_FORMAT_VERSION:
+        raise ValueError(
+            f'unsupported index format version {index["format_version"]}'
+        )
+    return {
+        key: (offset, length)
+        for key, (offset, length) in index['offsets'].items()
+    }
+
+def write_indexed_lines(
+    filename: str,
+    keyed_lines: Iterable[Tuple[str, Sequence[str]]],
+):
+    # every line is given with its key, as the pieces it is made of, and the
+    # index sidecar of the written lines is written afterwards
+    keys: List[str] = []
+    lengths: List[int] = []
+    with open(filename, 'w+', buffering=IO_BUFFER_SIZE) as out_f:
+        for key, pieces in keyed_lines:
+            out_f.writelines(pieces)
+            keys.append(key)
+            lengths.append(sum(map(_num_bytes, pieces)))
+    write_index(filename, keys, lengths)
+
+@dataclass
+class IndexedJsonlReader(object):
+    # Memory maps a jsonl file with an index sidecar, and decodes only the
+    # lines that are looked up.
+    filename: str
+
+    _index: Dict[str, Tuple[int, int]] = field(
+        default_factory=dict, init=False, repr=False,
+    )
+    _file: Optional[IO] = field(default=None, init=False, repr=False)
+    _mmap: Optional[mmap.mmap] = field(default=None, init=False, repr=False)
+
+    def __post_init__(self):
+        self._index = read_index(self.filename)
+        self._file = open(self.filename, 'rb')
+        if os.path.getsize(self.filename) > 0:
+            self._mmap = mmap.mmap(
+                self._file.fileno(), 0, access=mmap.ACCESS_READ,
+            )
+
+    def __enter__(self) -> IndexedJsonlReader:
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._index
+
+    def keys(self) -> List[str]:
+        return list(self._index.keys())
+
+    def get(self, key: str) -> Any:
+        offset, length = self._index[key]
+        return json_loads(self._mmap[offset:offset + length])
+
+    def get_many(self, keys: Iterable[str]) -> List[Any]:
+        return [self.get(key) for key in keys]
+
+    def sort_keys(self, keys: Iterable[str]) -> List[str]:
+        # the distinct keys in the order of their lines, and a KeyError for a
+        # key that is not in the file
+        return sorted(set(keys), key=lambda key: self._index[key][0])
+
+    def sample(self, k: int, seed: Optional[int] = None) -> List[Any]:
+        keys = random.Random(seed).sample(self.keys(), k)
+        return self.get_many(keys)
+
+def sha256_file(filename: str) -> str:
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as in_f:
+        for chunk in iter(lambda: in_f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def open_compressed(filename: str, mode: str, compression: str) -> IO:
+    if compression == 'gzip':
+        return gzip.open(filename, mode)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ImportError('zstd compression requires zstandard')
+        return zstandard.open(filename, mode)
+    raise ValueError(f'unsupported compression {compression}')
+
+def get_manifest_filename(filename: str) -> str:
+    return f'{os.path.splitext(filename)[0]}.manifest.json'
+
+def get_shard_filenames(
+    filename: str,
+    num_shards: int,
+    compression: str,
+) -> List[str]:
+    root, ext = os.path.splitext(filename)
+    ext += SHARD_EXTENSIONS[compression]
+    return [
+        f'{root}-{i:05d}-of-{num_shards:05d}{ext}' for i in range(num_shards)
+    ]
+
+def get_shard_sizes(num_lines: int, num_shards: int) -> List[int]:
+    # contiguous shards whose sizes differ by at most one line
+    return [
+        (i + 1) * num_lines // num_shards - i * num_lines // num_shards
+        for i in range(num_shards)
+    ]
+
+def _write_shard(
+    filename: str,
+    lines: Iterable[str],
+    compression: str,
+) -> Dict[str, Any]:
+    num_records = 0
+    with open_compressed(filename, 'wt', compression) as out_f:
+        for line in lines:
+            out_f.write(line)
+            num_records += 1
+    return {
+        'filename': os.path.basename(filename),
+        'num_records': num_records,
+        'num_bytes': os.path.getsize(filename),
+        'sha256': sha256_file(filename),
+    }
+
+def write_jsonl_shards(
+    filename: str,
+    shards: Sequence[Iterable[str]],
+    compression: str = 'gzip',
+    max_workers: Optional[int] = None,
+):
+    # Every shard is an iterable of encoded lines, and is compressed into its
+    # own file next to filename. The shards are written in parallel, but in
+    # order with max_workers=1, so they can be slices of one iterator.
+    filenames = get_shard_filenames(filename, len(shards), compression)
+    max_workers = max_workers or len(shards)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        shard_infos = list(executor.map(
+            _write_shard, filenames, shards, [compression] * len(shards),
+        ))
+    write_json(get_manifest_filename(filename), {
+        'format_version': SHARD_FORMAT_VERSION,
+        'compression': compression,
+        'num_records': sum(shard['num_records'] for shard in shard_infos),
+        'shards': shard_infos,
+    })
+
+def _read_shard(
+    filename: str,
+    shard: Dict[str, Any],
+    compression: str,
+    verify: bool,
+) -> List[Any]:
+    if verify and sha256_file(filename) != shard['sha256']:
+        raise ValueError(f'corrupted shard {filename}')
+    with open_compressed(filename, 'rt', compression) as in_f:
+        data = [json_loads(line) for line in in_f]
+    if len(data) != shard['num_records']:
+        raise ValueError(
+            f'expect {shard["num_records"]} records in {filename}, '
+            f'but read {len(data)}'
+        )
+    return data
+
+def read_jsonl_shards(
+    filename: str,
+    shard_ids: Optional[List[int]] = None,
+    max_workers: Optional[int] = None,
+    verify: bool = False,
+) -> List[Any]:
+    # reads the shards written by write_jsonl_shards for filename in parallel,
+    # or only the given shards, e.g. the ones of a worker of a training job
+    manifest = read_json(get_manifest_filename(filename))
+    if manifest['format_version'] != SHARD_FORMAT_VERSION:
+        raise ValueError(
+            f'unsupported shard format version {manifest["format_version"]}'
+        )
+    shards: List[Dict[str, Any]] = manifest['shards']
+    if shard_ids is not None:
+        shards = [shards[shard_id] for shard_id in shard_ids]
+    if len(shards) == 0: return []
+
+    dirname = os.path.dirname(filename)
+    max_workers = max_workers or len(shards)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        shard_data = executor.map(
+            _read_shard,
+            [os.path.join(dirname, shard['filename']) for shard in shards],
+            shards,
+            [manifest['compression']] * len(shards),
+            [verify] * len(shards),
+        )
+        return list(itertools.chain.from_iterable(shard_data))
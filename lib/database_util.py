@@ -1,54 +1,190 @@
 from __future__ import annotations
 
-from typing import List, Tuple
-from dataclasses import dataclass
+from typing import IO, Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import array
+import io
+import itertools
+import threading
 
-import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+
+from .text_diff_tool import IndRange, TextDiffTool
 
 BookKey = Tuple[str, str]
 CharKey = Tuple[str, str, str]
+MaskSpan = Tuple[IndRange, List[str]] # token range -> replacement tokens
 
+BOOK_INFO_CONDITION = "summary_text IS NOT NULL and summary_text <> ''"
+CHARACTER_INFO_CONDITION = (
+    "description_text IS NOT NULL AND description_text <> '' "
+    "AND character_name <> 'Major' "
+    "AND character_name <> 'Minor' "
+    "AND character_name <> 'Major Characters' "
+    "AND character_name <> 'Minor Characters'"
+)
 
-@dataclass
-class BookInfo(object):
-    book_title: str
-    source: str
-    summary: str
+# escapes of special characters in the text format of COPY
+_COPY_ESCAPES = str.maketrans({
+    '\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r',
+})
 
-    @property
-    def book_key(self) -> BookKey:
-        return (self.book_title, self.source)
 
-@dataclass
-class CharacterInfo(object):
-    character_name: str
-    book_title: str
-    source: str
-    description: str
+# Book keys are interned while records are loaded, so records of the same
+# book share one key tuple and one copy of its title and source, and so are
+# the replacement tokens of mask spans, since most of them are the same few
+# masks. The tables only live as long as the interning() scope, so they do
+# not grow for the life of the process. Outside of it, nothing is interned.
+_interned_book_keys: Optional[Dict[BookKey, BookKey]] = None
+_interned_mask_tokens: Optional[Dict[Tuple[str, ...], Tuple[str, ...]]] = None
+
+@contextmanager
+def interning() -> Iterator[None]:
+    global _interned_book_keys, _interned_mask_tokens
+    if _interned_book_keys is not None: # nested in another scope
+        yield
+        return
+    _interned_book_keys, _interned_mask_tokens = {}, {}
+    try:
+        yield
+    finally:
+        _interned_book_keys, _interned_mask_tokens = None, None
+
+def _intern_book_key(book_title: str, source: str) -> BookKey:
+    book_key = (book_title, source)
+    if _interned_book_keys is None: return book_key
+    return _interned_book_keys.setdefault(book_key, book_key)
+
+def _intern_mask_tokens(tokens: Sequence[str]) -> Tuple[str, ...]:
+    tokens = tuple(tokens)
+    if _interned_mask_tokens is None: return tokens
+    return _interned_mask_tokens.setdefault(tokens, tokens)
+
+
+class _Record(object):
+    # Records are slotted and store their keys as tuples, so looking up a key
+    # does not build a new tuple. Every record class lists its fields in
+    # _fields, in the order of its constructor arguments.
+    __slots__ = ()
+    _fields: Tuple[str, ...] = ()
+
+    def __repr__(self) -> str:
+        fields = ', '.join(
+            f'{name}={getattr(self, name)!r}' for name in self._fields
+        )
+        return f'{type(self).__name__}({fields})'
+
+    def __eq__(self, other: Any) -> bool:
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return all(
+            getattr(self, name) == getattr(other, name)
+            for name in self._fields
+        )
+
+    __hash__ = None # mutable, like the dataclasses these records replace
+
+    def __reduce__(self) -> Tuple[Any, Tuple[Any, ...]]:
+        # records are unpickled through their constructor, e.g. from the
+        # pipeline workers, so their keys and mask tokens are interned again
+        # in the interning() scope of the unpickling
+        return type(self), tuple(getattr(self, name) for name in self._fields)
+
+    def _set_book_key(self, book_title: str, source: str):
+        self._book_key = _intern_book_key(book_title, source)
 
     @property
     def book_key(self) -> BookKey:
-        return (self.book_title, self.source)
+        return self._book_key
 
     @property
-    def char_key(self) -> CharKey:
-        return (self.book_title, self.source, self.character_name)
+    def book_title(self) -> str:
+        return self._book_key[0]
 
-@dataclass
-class CharacterInfoWithMaskedDescription(object):
-    character_name: str
-    book_title: str
-    source: str
-    description: str
-    masked_description: str
+    @book_title.setter
+    def book_title(self, book_title: str):
+        self._set_book_key(book_title, self._book_key[1])
 
     @property
-    def book_key(self) -> BookKey:
-        return (self.book_title, self.source)
+    def source(self) -> str:
+        return self._book_key[1]
+
+    @source.setter
+    def source(self, source: str):
+        self._set_book_key(self._book_key[0], source)
+
+class _CharRecord(_Record):
+    __slots__ = ()
+
+    def _set_char_key(
+        self,
+        book_title: str,
+        source: str,
+        character_name: str,
+    ):
+        self._book_key = _intern_book_key(book_title, source)
+        self._char_key = (*self._book_key, character_name)
+
+    def _set_book_key(self, book_title: str, source: str):
+        self._set_char_key(book_title, source, self._char_key[2])
 
     @property
     def char_key(self) -> CharKey:
-        return (self.book_title, self.source, self.character_name)
+        return self._char_key
+
+    @property
+    def character_name(self) -> str:
+        return self._char_key[2]
+
+    @character_name.setter
+    def character_name(self, character_name: str):
+        self._set_char_key(*self._book_key, character_name)
+
+
+class BookInfo(_Record):
+    __slots__ = ('_book_key', 'summary')
+    _fields = ('book_title', 'source', 'summary')
+
+    def __init__(self, book_title: str, source: str, summary: str):
+        self._set_book_key(book_title, source)
+        self.summary = summary
+
+class CharacterInfo(_CharRecord):
+    __slots__ = ('_book_key', '_char_key', 'description')
+    _fields = ('character_name', 'book_title', 'source', 'description')
+
+    def __init__(
+        self,
+        character_name: str,
+        book_title: str,
+        source: str,
+        description: str,
+    ):
+        self._set_char_key(book_title, source, character_name)
+        self.description = description
+
+class CharacterInfoWithMaskedDescription(_CharRecord):
+    __slots__ = (
+        '_book_key', '_char_key', 'description', 'masked_description',
+    )
+    _fields = (
+        'character_name', 'book_title', 'source',
+        'description', 'masked_description',
+    )
+
+    def __init__(
+        self,
+        character_name: str,
+        book_title: str,
+        source: str,
+        description: str,
+        masked_description: str,
+    ):
+        self._set_char_key(book_title, source, character_name)
+        self.description = description
+        self.masked_description = masked_description
 
     @classmethod
     def generate_from_char_info(
@@ -63,6 +199,69 @@ class CharacterInfoWithMaskedDescription(object):
             masked_description=masked_description,
         )
 
+class CharacterInfoWithMaskSpans(_CharRecord):
+    # Keeps the masking as the spans of the description tokens that are
+    # replaced, in the format of the masked description changes, instead of
+    # a second copy of the description. The token ranges are packed into one
+    # array and the replacements are interned, and the masked description is
+    # only built when it is read.
+    __slots__ = (
+        '_book_key', '_char_key', 'description',
+        '_mask_ranges', '_mask_tokens',
+    )
+    _fields = (
+        'character_name', 'book_title', 'source',
+        'description', 'mask_spans',
+    )
+
+    def __init__(
+        self,
+        character_name: str,
+        book_title: str,
+        source: str,
+        description: str,
+        mask_spans: Sequence[MaskSpan],
+    ):
+        self._set_char_key(book_title, source, character_name)
+        self.description = description
+        self.mask_spans = mask_spans
+
+    @property
+    def mask_spans(self) -> List[MaskSpan]:
+        ranges = self._mask_ranges
+        return [
+            ((ranges[2 * i], ranges[2 * i + 1]), list(tokens))
+            for i, tokens in enumerate(self._mask_tokens)
+        ]
+
+    @mask_spans.setter
+    def mask_spans(self, mask_spans: Sequence[MaskSpan]):
+        self._mask_ranges = array.array('i', [
+            ind for ind_range, _ in mask_spans for ind in ind_range
+        ])
+        self._mask_tokens = tuple([
+            _intern_mask_tokens(tokens) for _, tokens in mask_spans
+        ])
+
+    @property
+    def masked_description(self) -> str:
+        return ' '.join(TextDiffTool.restore_list_from_text(
+            self.description, self.mask_spans,
+        ))
+
+    @classmethod
+    def generate_from_char_info(
+        cls, char_info: CharacterInfo,
+        mask_spans: Sequence[MaskSpan],
+    ) -> CharacterInfoWithMaskSpans:
+        return cls(
+            character_name=char_info.character_name,
+            book_title=char_info.book_title,
+            source=char_info.source,
+            description=char_info.description,
+            mask_spans=mask_spans,
+        )
+
 
 @dataclass
 class DatabaseConnection(object):
@@ -70,49 +269,351 @@ class DatabaseConnection(object):
     user: str # database user name
     password: str # user password
     dbname: str # database name
+    batch_size: int = 2000 # number of rows fetched per round trip
+    max_connections: int = 2 # number of pooled connections
+
+    _pool: Optional[ThreadedConnectionPool] = field(
+        default=None, init=False, repr=False,
+    )
+    _cursor_ids: Iterator[int] = field(
+        default_factory=itertools.count, init=False, repr=False,
+    )
+    _pool_lock: threading.Lock = field(
+        default_factory=threading.Lock, init=False, repr=False,
+    )
+
+    def __enter__(self) -> DatabaseConnection:
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+
+    def _get_pool(self) -> ThreadedConnectionPool:
+        # the pool is created once, even if threads ask for it together
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadedConnectionPool(
+                    1, self.max_connections,
+                    host=self.host,
+                    user=self.user,
+                    password=self.password,
+                    dbname=self.dbname,
+                )
+            return self._pool
+
+    @contextmanager
+    def connection(self) -> Iterator[Any]:
+        # a connection goes back to the pool it came from
+        pool = self._get_pool()
+        conn = pool.getconn()
+        try:
+            yield conn
+        finally:
+            # end the transaction opened by the query before reusing it, and
+            # close a connection that cannot be, so it is not leaked
+            try:
+                conn.rollback()
+            except Exception:
+                pool.putconn(conn, close=True)
+                raise
+            pool.putconn(conn)
 
-    def _connect(self):
-        self.conn = psycopg2.connect(
-            host=self.host,
-            user=self.user,
-            password=self.password,
-            dbname=self.dbname,
+    def _iter_cursor(
+        self,
+        conn: Any,
+        query: str,
+        params: Optional[Sequence[Any]] = None,
+    ) -> Iterator[Tuple[Any, ...]]:
+        # a named cursor keeps the result set on the server, so at most
+        # batch_size rows are held in memory at a time
+        cursor_name = f'lcd_cursor_{next(self._cursor_ids)}'
+        with conn.cursor(name=cursor_name) as cur:
+            cur.execute(query, params)
+            while True:
+                rows = cur.fetchmany(self.batch_size)
+                if len(rows) == 0: break
+                yield from rows
+
+    @staticmethod
+    def _copy_rows(
+        conn: Any,
+        table_name: str,
+        rows: Iterable[Sequence[str]],
+    ):
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write('\t'.join(
+                val.translate(_COPY_ESCAPES) for val in row
+            ) + '\n')
+        buffer.seek(0)
+        with conn.cursor() as cur:
+            cur.copy_expert(f'COPY {table_name} FROM STDIN', buffer)
+            cur.execute(f'ANALYZE {table_name};')
+
+    def iter_query(
+        self,
+        query: str,
+        params: Optional[Sequence[Any]] = None,
+    ) -> Iterator[Tuple[Any, ...]]:
+        with self.connection() as conn:
+            yield from self._iter_cursor(conn, query, params)
+
+    def read_column_names(self, table_name: str) -> List[str]:
+        query = (
+            # a table of the same name in another schema is not the one
+            # copied by copy_table_to_file
+            'SELECT column_name FROM information_schema.columns '
+            'WHERE table_name = %s AND table_schema = current_schema() '
+            'ORDER BY ordinal_position;'
         )
-        self.cur = self.conn.cursor()
+        return [row[0] for row in self.iter_query(query, (table_name,))]
 
-    def _close(self):
-        self.cur.close()
-        self.conn.close()
+    def copy_table_to_file(
+        self,
+        table_name: str,
+        columns: List[str],
+        out_f: IO[bytes],
+    ) -> int:
+        column_list = ','.join(columns)
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.copy_expert(
+                    f'COPY {table_name} ({column_list}) '
+                    'TO STDOUT WITH (FORMAT binary);',
+                    out_f,
+                )
+                return cur.rowcount
 
-    def read_book_info(self) -> List[BookInfo]:
-        self._connect()
+    def copy_file_to_table(
+        self,
+        table_name: str,
+        columns: List[str],
+        in_f: IO[bytes],
+    ) -> int:
+        column_list = ','.join(columns)
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.copy_expert(
+                    f'COPY {table_name} ({column_list}) '
+                    'FROM STDIN WITH (FORMAT binary);',
+                    in_f,
+                )
+                num_rows = cur.rowcount
+            conn.commit()
+        return num_rows
+
+    def refresh_materialized_view(self, view_name: str):
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f'REFRESH MATERIALIZED VIEW {view_name};')
+            conn.commit()
+
+    def read_max_row_version(self) -> int:
         query = (
-            'SELECT book_title, source, summary_text FROM literatures '
-            "WHERE summary_text IS NOT NULL and summary_text <> '';"
+            'SELECT GREATEST('
+            '(SELECT MAX(row_version) FROM literatures), '
+            '(SELECT MAX(row_version) FROM characters));'
         )
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(query)
+                row_version = cur.fetchone()[0]
+        return 0 if row_version is None else row_version
 
-        self.cur.execute(query)
-        books: List[BookInfo] = [
-            BookInfo(*row) for row in self.cur.fetchall()
-        ]
-        self._close()
-        return books
+    def read_changed_char_keys(self, row_version: int) -> List[CharKey]:
+        # a character also changes when the summary of its book changes
+        query = (
+            'SELECT book_title, source, character_name FROM characters '
+            'WHERE row_version > %s '
+            'UNION '
+            'SELECT book_title, source, character_name FROM characters '
+            'JOIN literatures USING (book_title, source) '
+            'WHERE literatures.row_version > %s;'
+        )
+        return list(self.iter_query(query, (row_version, row_version)))
 
-    def read_character_info(self) -> List[CharacterInfo]:
-        self._connect()
+    def iter_book_info(self) -> Iterator[BookInfo]:
+        query = (
+            'SELECT book_title, source, summary_text FROM literatures '
+            f'WHERE {BOOK_INFO_CONDITION};'
+        )
+        for row in self.iter_query(query):
+            yield BookInfo(*row)
+
+    def iter_character_info(self) -> Iterator[CharacterInfo]:
         query = (
             'SELECT character_name, book_title, source, description_text '
             'FROM characters '
-            "WHERE description_text IS NOT NULL AND description_text <> '' "
-            "AND character_name <> 'Major' "
-            "AND character_name <> 'Minor' "
-            "AND character_name <> 'Major Characters' "
-            "AND character_name <> 'Minor Characters';"
+            f'WHERE {CHARACTER_INFO_CONDITION};'
         )
+        for row in self.iter_query(query):
+            yield CharacterInfo(*row)
 
-        self.cur.execute(query)
-        characters: List[CharacterInfo] = [
-            CharacterInfo(*row) for row in self.cur.fetchall()
-        ]
-        self._close()
-        return characters
\ No newline at end of file
+    def read_book_info(self) -> List[BookInfo]:
+        return list(self.iter_book_info())
+
+    def read_character_info(self) -> List[CharacterInfo]:
+        return list(self.iter_character_info())
+
+    def read_book_and_character_info(
+        self,
+    ) -> Tuple[List[BookInfo], List[CharacterInfo]]:
+        # both queries run at the same time on separate pooled connections
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            books = executor.submit(self.read_book_info)
+            characters = executor.submit(self.read_character_info)
+            return books.result(), characters.result()
+
+    @staticmethod
+    def _to_book_character_info(
+        rows: Iterable[Tuple[Any, ...]],
+    ) -> Iterator[Tuple[BookInfo, CharacterInfo]]:
+        # rows are ordered by book, so the characters of a book are
+        # consecutive and share a single BookInfo
+        book_info: Optional[BookInfo] = None
+        for title, source, name, summary, description in rows:
+            if book_info is None or book_info.book_key != (title, source):
+                book_info = BookInfo(title, source, summary)
+            yield book_info, CharacterInfo(name, title, source, description)
+
+    @staticmethod
+    def _split_book_character_info(
+        pairs: Iterable[Tuple[BookInfo, CharacterInfo]],
+    ) -> Tuple[List[BookInfo], List[CharacterInfo]]:
+        books: List[BookInfo] = []
+        characters: List[CharacterInfo] = []
+        for book_info, char_info in pairs:
+            if len(books) == 0 or books[-1] is not book_info:
+                books.append(book_info)
+            characters.append(char_info)
+        return books, characters
+
+    def iter_book_character_info(
+        self,
+    ) -> Iterator[Tuple[BookInfo, CharacterInfo]]:
+        query = (
+            'SELECT book_title, source, character_name, '
+            'summary_text, description_text FROM book_characters '
+            'ORDER BY book_title, source, character_name;'
+        )
+        return self._to_book_character_info(self.iter_query(query))
+
+    def read_book_and_character_info_from_view(
+        self,
+    ) -> Tuple[List[BookInfo], List[CharacterInfo]]:
+        return self._split_book_character_info(
+            self.iter_book_character_info()
+        )
+
+    def read_book_and_character_info_by_keys(
+        self,
+        book_keys: Iterable[BookKey],
+        char_keys: Iterable[CharKey],
+        from_view: bool = False,
+    ) -> Tuple[List[BookInfo], List[CharacterInfo]]:
+        # the wanted keys are copied into temporary tables so that only the
+        # matching rows leave the database
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    'CREATE TEMP TABLE wanted_books '
+                    '(book_title TEXT, source TEXT) ON COMMIT DROP;'
+                    'CREATE TEMP TABLE wanted_characters '
+                    '(book_title TEXT, source TEXT, character_name TEXT) '
+                    'ON COMMIT DROP;'
+                )
+            self._copy_rows(conn, 'wanted_books', set(book_keys))
+            self._copy_rows(conn, 'wanted_characters', set(char_keys))
+
+            if from_view:
+                query = (
+                    'SELECT book_title, source, character_name, '
+                    'summary_text, description_text FROM book_characters '
+                    'JOIN wanted_characters '
+                    'USING (book_title, source, character_name) '
+                    'ORDER BY book_title, source, character_name;'
+                )
+                return self._split_book_character_info(
+                    self._to_book_character_info(
+                        self._iter_cursor(conn, query)
+                    )
+                )
+
+            book_query = (
+                'SELECT book_title, source, summary_text FROM literatures '
+                'JOIN wanted_books USING (book_title, source) '
+                f'WHERE {BOOK_INFO_CONDITION};'
+            )
+            books: List[BookInfo] = [
+                BookInfo(*row)
+                for row in self._iter_cursor(conn, book_query)
+            ]
+
+            char_query = (
+                'SELECT character_name, book_title, source, description_text '
+                'FROM characters '
+                'JOIN wanted_characters '
+                'USING (book_title, source, character_name) '
+                f'WHERE {CHARACTER_INFO_CONDITION};'
+            )
+            characters: List[CharacterInfo] = [
+                CharacterInfo(*row)
+                for row in self._iter_cursor(conn, char_query)
+            ]
+        return books, characters
+
+    def iter_book_character_info_in_order(
+        self,
+        char_key_candidates: List[List[CharKey]],
+        from_view: bool = False,
+    ) -> Iterator[Tuple[int, BookInfo, CharacterInfo]]:
+        # yields one row per position of char_key_candidates, in order, using
+        # the first candidate key found in the database
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    'CREATE TEMP TABLE ordered_characters '
+                    '(ordinal INT, priority INT, book_title TEXT, '
+                    'source TEXT, character_name TEXT) ON COMMIT DROP;'
+                )
+            self._copy_rows(conn, 'ordered_characters', (
+                (str(ordinal), str(priority), *char_key)
+                for ordinal, candidates in enumerate(char_key_candidates)
+                for priority, char_key in enumerate(candidates)
+            ))
+
+            if from_view:
+                query = (
+                    'SELECT DISTINCT ON (ordinal) ordinal, book_title, '
+                    'source, character_name, summary_text, description_text '
+                    'FROM ordered_characters '
+                    'JOIN book_characters '
+                    'USING (book_title, source, character_name) '
+                    'ORDER BY ordinal, priority;'
+                )
+            else:
+                query = (
+                    'SELECT DISTINCT ON (ordinal) ordinal, book_title, '
+                    'source, character_name, summary_text, description_text '
+                    'FROM ordered_characters '
+                    'JOIN characters '
+                    'USING (book_title, source, character_name) '
+                    'JOIN literatures USING (book_title, source) '
+                    f'WHERE {BOOK_INFO_CONDITION} '
+                    f'AND {CHARACTER_INFO_CONDITION} '
+                    'ORDER BY ordinal, priority;'
+                )
+            for ordinal, title, source, name, summary, description in (
+                self._iter_cursor(conn, query)
+            ):
+                yield (
+                    ordinal,
+                    BookInfo(title, source, summary),
+                    CharacterInfo(name, title, source, description),
+                )
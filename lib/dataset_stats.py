@@ -0,0 +1,206 @@
+from typing import Any, Dict, List, Optional, Tuple
+import hashlib
+import itertools
+import os
+
+import numpy as np
+
+from .book_char_dataset import iter_dataset_records
+from .common_util import read_json, write_json
+
+STATS_FORMAT_VERSION = 1
+MASK_TOKEN = '[MASK]'
+PERCENTILES = [5, 25, 50, 75, 95]
+
+CHAR_METRICS = ['description_chars', 'description_tokens', 'mask_count']
+BOOK_METRICS = ['summary_chars', 'summary_tokens', 'num_characters']
+
+def get_stats_filename(filename: str) -> str:
+    return f'{os.path.splitext(filename)[0]}.stats.json'
+
+def _get_fingerprint(
+    filename: str,
+    split_keys: Dict[str, List[str]],
+) -> Dict[str, Any]:
+    # the cache is only used for the same dataset file and the same splits
+    file_stat = os.stat(filename)
+    split_digest = hashlib.sha256()
+    for split in sorted(split_keys):
+        split_digest.update(split.encode('utf-8') + b'\0')
+        split_digest.update('\n'.join(split_keys[split]).encode('utf-8'))
+        split_digest.update(b'\0')
+    return {
+        'size': file_stat.st_size,
+        'mtime_ns': file_stat.st_mtime_ns,
+        'splits': split_digest.hexdigest(),
+    }
+
+def _summarize(values: np.ndarray) -> Dict[str, float]:
+    if len(values) == 0:
+        return {'count': 0}
+    summary = {'count': int(len(values)), 'mean': float(values.mean())}
+    for percentile, value in zip(
+        PERCENTILES, np.percentile(values, PERCENTILES),
+    ):
+        summary[f'p{percentile}'] = float(value)
+    return summary
+
+def _summarize_groups(
+    metrics: Dict[str, np.ndarray],
+    groups: Dict[str, np.ndarray],
+) -> Dict[str, Dict[str, Dict[str, float]]]:
+    return {
+        group: {
+            name: _summarize(values[mask]) for name, values in metrics.items()
+        }
+        for group, mask in groups.items()
+    }
+
+def _factorize(
+    values: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # the distinct values in the order they first appear, the position of
+    # their first appearance, and the id of the distinct value of every value
+    uniques, first, inverse = np.unique(
+        values, return_index=True, return_inverse=True,
+    )
+    order = np.argsort(first, kind='stable')
+    ids = np.empty(len(order), dtype=np.int64)
+    ids[order] = np.arange(len(order))
+    return uniques[order], first[order], ids[inverse.reshape(-1)]
+
+def _lengths(texts: List[str]) -> np.ndarray:
+    return np.fromiter(map(len, texts), dtype=np.int64, count=len(texts))
+
+def _counts(texts: List[str], sub: str) -> np.ndarray:
+    return np.fromiter(
+        map(str.count, texts, itertools.repeat(sub)),
+        dtype=np.int64, count=len(texts),
+    )
+
+def compute_statistics(
+    filename: str,
+    split_keys: Optional[Dict[str, List[str]]] = None,
+) -> Dict[str, Any]:
+    # Reads the columns of an exported dataset file in one pass, builds the
+    # lengths and counts of all records as NumPy arrays, and returns their
+    # percentiles for the whole file, every source and every split. The
+    # character metrics are per character, and the book metrics per book. A
+    # book is in a split if any of its characters is.
+    split_keys = split_keys or {}
+    split_names = sorted(split_keys)
+    split_lookup: Dict[str, int] = {}
+    for split_id, split in enumerate(split_names):
+        for key in split_keys[split]:
+            split_lookup[key] = split_id
+
+    # only the first summary of every book is kept
+    columns: Dict[str, List[str]] = {
+        name: [] for name in [
+            'book_title', 'source', 'character_name', 'description', 'masks',
+        ]
+    }
+    summaries: Dict[Tuple[str, str], str] = {}
+    for record in iter_dataset_records(filename):
+        for name in ['book_title', 'source', 'character_name', 'description']:
+            columns[name].append(record[name])
+        summaries.setdefault(
+            (record['book_title'], record['source']), record['summary'],
+        )
+        # the replacements of the mask spans are the masked tokens
+        columns['masks'].append(
+            ' '.join(
+                token for _, tokens in record['mask_spans']
+                for token in tokens
+            ) if 'mask_spans' in record else record['masked_description']
+        )
+
+    titles = np.array(columns['book_title'], dtype=object)
+    sources = np.array(columns['source'], dtype=object)
+    source_names, _, source_ids = _factorize(sources)
+    _, book_firsts, book_ids = _factorize(titles + '\0' + sources)
+    # the name|title|source keys of get_key_str
+    keys = (
+        np.array(columns['character_name'], dtype=object)
+        + '|' + titles + '|' + sources
+    )
+    chars = {
+        'description_chars': _lengths(columns['description']),
+        'description_tokens': _counts(columns['description'], ' ') + 1,
+        'mask_count': _counts(columns['masks'], MASK_TOKEN),
+        'source': source_ids,
+        'split': np.fromiter(
+            map(split_lookup.get, keys, itertools.repeat(-1)),
+            dtype=np.int64, count=len(keys),
+        ),
+        'book': book_ids,
+    }
+    book_summaries = [
+        summaries[(titles[i], sources[i])] for i in book_firsts
+    ]
+    books = {
+        'summary_chars': _lengths(book_summaries),
+        'summary_tokens': _counts(book_summaries, ' ') + 1,
+        'source': source_ids[book_firsts],
+        'num_characters': np.bincount(
+            book_ids, minlength=len(book_firsts),
+        ),
+    }
+
+    char_groups = {'all': np.ones(len(keys), dtype=bool)}
+    book_groups = {'all': np.ones(len(book_firsts), dtype=bool)}
+    for source_id, source in enumerate(source_names):
+        char_groups[f'source:{source}'] = chars['source'] == source_id
+        book_groups[f'source:{source}'] = books['source'] == source_id
+    for split_id, split in enumerate(split_names):
+        in_split = chars['split'] == split_id
+        char_groups[f'split:{split}'] = in_split
+        book_groups[f'split:{split}'] = np.bincount(
+            chars['book'][in_split], minlength=len(book_firsts),
+        ) > 0
+
+    return {
+        'characters': _summarize_groups(
+            {name: chars[name] for name in CHAR_METRICS}, char_groups,
+        ),
+        'books': _summarize_groups(
+            {name: books[name] for name in BOOK_METRICS}, book_groups,
+        ),
+    }
+
+def load_statistics(
+    filename: str,
+    split_keys: Optional[Dict[str, List[str]]] = None,
+) -> Dict[str, Any]:
+    # the statistics are cached next to the dataset file, and computed again
+    # when the file or the splits change
+    split_keys = split_keys or {}
+    fingerprint = _get_fingerprint(filename, split_keys)
+    stats_filename = get_stats_filename(filename)
+    if os.path.exists(stats_filename):
+        cache = read_json(stats_filename)
+        if (
+            cache['format_version'] == STATS_FORMAT_VERSION
+            and cache['fingerprint'] == fingerprint
+        ):
+            return cache['statistics']
+
+    statistics = compute_statistics(filename, split_keys)
+    write_json(stats_filename, {
+        'format_version': STATS_FORMAT_VERSION,
+        'fingerprint': fingerprint,
+        'statistics': statistics,
+    })
+    return statistics
+
+def format_statistics(statistics: Dict[str, Any]) -> str:
+    lines: List[str] = []
+    for kind in ['characters', 'books']:
+        for group, metrics in statistics[kind].items():
+            lines.append(f'[{kind} {group}]')
+            for name, summary in metrics.items():
+                values = ', '.join(
+                    f'{key}={value:g}' for key, value in summary.items()
+                )
+                lines.append(f'  {name}: {values}')
+    return '\n'.join(lines)
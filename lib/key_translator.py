@@ -1,11 +1,12 @@
 from __future__ import annotations
 
-from typing import Any, Dict, Optional
-from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional, Set
+from dataclasses import dataclass, field
 import ast
 
 from .database_util import BookKey, CharKey
 from .common_util import read_json
+from .book_char_subset import BookCharSubset
 
 @dataclass
 class KeyTranslator(object):
@@ -14,13 +15,39 @@ class KeyTranslator(object):
     new_to_old_char_key_mapping: Dict[CharKey, CharKey]
     old_to_new_char_key_mapping: Dict[CharKey, CharKey]
 
+    _new_char_keys_by_old: Dict[CharKey, List[CharKey]] = field(
+        default_factory=dict, init=False, repr=False,
+    )
+
+    def __post_init__(self):
+        for new_key, old_key in self.new_to_old_char_key_mapping.items():
+            self._new_char_keys_by_old.setdefault(old_key, []).append(new_key)
+
     @staticmethod
-    def load_mapping(filename: str) -> dict:
+    def load_mapping(
+        filename: str,
+        subset: Optional[BookCharSubset] = None,
+        old_keys_are_values: bool = False,
+    ) -> dict:
         mapping: Dict[str, str] = read_json(filename)
-        return {
-            ast.literal_eval(key): ast.literal_eval(val)
-            for key, val in mapping.items()
-        }
+        if subset is None:
+            return {
+                ast.literal_eval(key): ast.literal_eval(val)
+                for key, val in mapping.items()
+            }
+
+        # only the entries whose old key is in the subset are parsed
+        parsed_mapping = {}
+        for key, val in mapping.items():
+            old_key_str = val if old_keys_are_values else key
+            if not subset.may_contain_key_str(old_key_str): continue
+            old_key = ast.literal_eval(old_key_str)
+            if len(old_key) == 2 and not subset.contains_book_key(old_key):
+                continue
+            if len(old_key) == 3 and not subset.contains_char_key(old_key):
+                continue
+            parsed_mapping[ast.literal_eval(key)] = ast.literal_eval(val)
+        return parsed_mapping
 
     @classmethod
     def load_from_json_files(
@@ -29,12 +56,19 @@ class KeyTranslator(object):
         old_to_new_book_key_mapping_filename: str,
         new_to_old_char_key_mapping_filename: str,
         old_to_new_char_key_mapping_filename: str,
+        subset: Optional[BookCharSubset] = None,
     ) -> KeyTranslator:
         return cls(
-            cls.load_mapping(new_to_old_book_key_mapping_filename),
-            cls.load_mapping(old_to_new_book_key_mapping_filename),
-            cls.load_mapping(new_to_old_char_key_mapping_filename),
-            cls.load_mapping(old_to_new_char_key_mapping_filename),
+            cls.load_mapping(
+                new_to_old_book_key_mapping_filename, subset,
+                old_keys_are_values=True,
+            ),
+            cls.load_mapping(old_to_new_book_key_mapping_filename, subset),
+            cls.load_mapping(
+                new_to_old_char_key_mapping_filename, subset,
+                old_keys_are_values=True,
+            ),
+            cls.load_mapping(old_to_new_char_key_mapping_filename, subset),
         )
 
     def to_new_book_key(self, old_book_key: BookKey) -> Optional[BookKey]:
@@ -47,4 +81,39 @@ class KeyTranslator(object):
         return self.old_to_new_char_key_mapping.get(old_char_key, None)
     
     def to_old_char_key(self, new_char_key: CharKey) -> Optional[CharKey]:
-        return self.new_to_old_char_key_mapping.get(new_char_key, None)
\ No newline at end of file
+        return self.new_to_old_char_key_mapping.get(new_char_key, None)
+
+    def to_new_book_keys(
+        self,
+        old_book_keys: Iterable[BookKey],
+    ) -> List[BookKey]:
+        # every book key that is kept or translated to one of old_book_keys
+        wanted_keys: Set[BookKey] = set(old_book_keys)
+        new_book_keys = set(wanted_keys)
+        for new_key, old_key in self.new_to_old_book_key_mapping.items():
+            if old_key in wanted_keys:
+                new_book_keys.add(new_key)
+        return list(new_book_keys)
+
+    def to_new_char_keys(
+        self,
+        old_char_keys: Iterable[CharKey],
+    ) -> List[CharKey]:
+        # every char key that is kept or translated to one of old_char_keys
+        wanted_keys: Set[CharKey] = set(old_char_keys)
+        new_char_keys = set(wanted_keys)
+        for new_key, old_key in self.new_to_old_char_key_mapping.items():
+            if old_key in wanted_keys:
+                new_char_keys.add(new_key)
+        return list(new_char_keys)
+
+    def to_new_char_key_candidates(
+        self,
+        old_char_key: CharKey,
+    ) -> List[CharKey]:
+        # the translated keys come before the key itself, which is only a
+        # candidate when it is not translated to another key
+        candidates = list(self._new_char_keys_by_old.get(old_char_key, []))
+        if old_char_key not in self.new_to_old_char_key_mapping:
+            candidates.append(old_char_key)
+        return candidates
\ No newline at end of file
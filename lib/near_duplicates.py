@@ -0,0 +1,220 @@
+from typing import Any, Dict, Hashable, List, Optional, Set, Tuple
+from dataclasses import dataclass, field
+import zlib
+
+import numpy as np
+
+from .book_char_dataset import FinalBookCharDataset, get_key_str
+from .database_util import BookKey
+
+_SHINGLE_BASE = np.uint64(1099511628211) # combines the token hashes
+
+def get_shingle_hashes(text: str, shingle_size: int) -> np.ndarray:
+    # the distinct hashes of the runs of shingle_size casefolded words, from
+    # the hashes of the words, so every word is hashed once
+    tokens = text.casefold().split()
+    token_hashes = np.array(
+        [zlib.crc32(token.encode('utf-8')) for token in tokens] or [0],
+        dtype=np.uint64,
+    )
+    num_shingles = max(len(token_hashes) - shingle_size + 1, 1)
+    shingle_hashes = token_hashes[:num_shingles].copy()
+    for i in range(1, min(shingle_size, len(token_hashes))):
+        shingle_hashes *= _SHINGLE_BASE
+        shingle_hashes += token_hashes[i:i + num_shingles]
+    return np.unique(shingle_hashes)
+
+class _DisjointSet(object):
+    def __init__(self, size: int):
+        self.parents = list(range(size))
+
+    def find(self, i: int) -> int:
+        while self.parents[i] != i:
+            self.parents[i] = self.parents[self.parents[i]]
+            i = self.parents[i]
+        return i
+
+    def union(self, i: int, j: int):
+        self.parents[self.find(i)] = self.find(j)
+
+@dataclass
+class MinHashLSH(object):
+    # Finds the clusters of near-duplicate texts by the Jaccard similarity
+    # of their word shingles. Every text gets a MinHash signature of
+    # num_perm hashes, and only the texts that share all rows of one of the
+    # num_bands bands of their signatures are compared, so the time is
+    # about linear in the number of texts.
+    num_perm: int = 128 # number of hashes of a signature
+    num_bands: int = 16 # number of LSH bands, a divisor of num_perm
+    shingle_size: int = 3 # number of words of a shingle
+    seed: int = 0 # seed of the hash functions
+
+    _keys: List[Hashable] = field(
+        default_factory=list, init=False, repr=False,
+    )
+    _signatures: List[np.ndarray] = field(
+        default_factory=list, init=False, repr=False,
+    )
+    _coefficients: Optional[Tuple[np.ndarray, np.ndarray]] = field(
+        default=None, init=False, repr=False,
+    )
+
+    def __post_init__(self):
+        if self.num_perm % self.num_bands != 0:
+            raise ValueError('num_bands must divide num_perm')
+        # multiply-shift hashing: odd multipliers, and the high 32 bits
+        rng = np.random.default_rng(self.seed)
+        self._coefficients = (
+            rng.integers(0, 2**64, self.num_perm, dtype=np.uint64)
+            | np.uint64(1),
+            rng.integers(0, 2**64, self.num_perm, dtype=np.uint64),
+        )
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def get_signature(self, text: str) -> np.ndarray:
+        multipliers, increments = self._coefficients
+        shingle_hashes = get_shingle_hashes(text, self.shingle_size)
+        hashes = (
+            multipliers[:, None] * shingle_hashes[None, :]
+            + increments[:, None]
+        ) >> np.uint64(32)
+        return hashes.min(axis=1).astype(np.uint32)
+
+    def add(self, key: Hashable, text: str):
+        self._keys.append(key)
+        self._signatures.append(self.get_signature(text))
+
+    def _get_candidate_pairs(self, ids: List[int]) -> Set[Tuple[int, int]]:
+        rows = self.num_perm // self.num_bands
+        pairs: Set[Tuple[int, int]] = set()
+        for band in range(self.num_bands):
+            buckets: Dict[bytes, List[int]] = {}
+            for i in ids:
+                buckets.setdefault(
+                    self._signatures[i][band * rows:(band + 1) * rows]
+                    .tobytes(),
+                    [],
+                ).append(i)
+            for bucket in buckets.values():
+                for j, first in enumerate(bucket):
+                    for second in bucket[j + 1:]:
+                        pairs.add((first, second))
+        return pairs
+
+    def find_clusters(self, threshold: float = 0.8) -> List[List[Hashable]]:
+        # The texts with the same signature are merged first, so that exact
+        # duplicates do not fill the buckets with pairs. A candidate pair is
+        # merged if the share of equal hashes of their signatures, the
+        # estimate of their Jaccard similarity, is at least threshold.
+        # Clusters of more than one text are returned in the order of their
+        # first texts, and their texts in the order they were added.
+        disjoint_set = _DisjointSet(len(self._keys))
+        representatives: Dict[bytes, int] = {}
+        for i, signature in enumerate(self._signatures):
+            first = representatives.setdefault(signature.tobytes(), i)
+            if first != i:
+                disjoint_set.union(i, first)
+
+        for first, second in self._get_candidate_pairs(
+            list(representatives.values())
+        ):
+            similarity = np.mean(
+                self._signatures[first] == self._signatures[second]
+            )
+            if similarity >= threshold:
+                disjoint_set.union(first, second)
+
+        clusters: Dict[int, List[Hashable]] = {}
+        for i, key in enumerate(self._keys):
+            clusters.setdefault(disjoint_set.find(i), []).append(key)
+        return [cluster for cluster in clusters.values() if len(cluster) > 1]
+
+def find_description_clusters(
+    dataset: FinalBookCharDataset,
+    threshold: float = 0.8,
+    **lsh_args: Any,
+) -> List[List[str]]:
+    # clusters of name|title|source keys
+    lsh = MinHashLSH(**lsh_args)
+    for char_info in dataset.char_lookup.values():
+        lsh.add(get_key_str(char_info.char_key), char_info.description)
+    return lsh.find_clusters(threshold)
+
+def find_summary_clusters(
+    dataset: FinalBookCharDataset,
+    threshold: float = 0.8,
+    **lsh_args: Any,
+) -> List[List[BookKey]]:
+    lsh = MinHashLSH(**lsh_args)
+    for book_info in dataset.book_lookup.values():
+        lsh.add(book_info.book_key, book_info.summary)
+    return lsh.find_clusters(threshold)
+
+def report_near_duplicates(
+    dataset: FinalBookCharDataset,
+    split_keys: Optional[Dict[str, List[str]]] = None,
+    threshold: float = 0.8,
+    **lsh_args: Any,
+) -> Dict[str, List[Dict[str, Any]]]:
+    # Every cluster of near-duplicate descriptions or summaries, with the
+    # sources and splits of its records. A book is in a split if any of its
+    # characters is, and a cluster in more than one split is a leak.
+    split_keys = split_keys or {}
+    char_splits: Dict[str, Set[str]] = {}
+    book_splits: Dict[BookKey, Set[str]] = {}
+    key_books = {
+        get_key_str(char_key): char_key[:2]
+        for char_key in dataset.char_lookup
+    }
+    for split, keys in split_keys.items():
+        for key in keys:
+            char_splits.setdefault(key, set()).add(split)
+            if key in key_books:
+                book_splits.setdefault(key_books[key], set()).add(split)
+
+    report: Dict[str, List[Dict[str, Any]]] = {
+        'descriptions': [], 'summaries': [],
+    }
+    for cluster in find_description_clusters(dataset, threshold, **lsh_args):
+        report['descriptions'].append({
+            'keys': cluster,
+            'sources': sorted(set(key_books[key][1] for key in cluster)),
+            'splits': sorted(set().union(*[
+                char_splits.get(key, set()) for key in cluster
+            ])),
+        })
+    for cluster in find_summary_clusters(dataset, threshold, **lsh_args):
+        report['summaries'].append({
+            'keys': [list(book_key) for book_key in cluster],
+            'sources': sorted(set(source for _, source in cluster)),
+            'splits': sorted(set().union(*[
+                book_splits.get(book_key, set()) for book_key in cluster
+            ])),
+        })
+    return report
+
+def format_near_duplicates(
+    report: Dict[str, List[Dict[str, Any]]],
+    verbose: bool = False,
+) -> str:
+    # the counts of clusters, and the clusters across splits, or every
+    # cluster if verbose
+    lines: List[str] = []
+    for kind, clusters in report.items():
+        leaks = [c for c in clusters if len(c['splits']) > 1]
+        lines.append(
+            f'[{kind}] {len(clusters)} clusters of '
+            f'{sum(len(c["keys"]) for c in clusters)} records, '
+            f'{sum(len(c["sources"]) > 1 for c in clusters)} across sources, '
+            f'{len(leaks)} across splits'
+        )
+        for cluster in clusters if verbose else leaks:
+            splits = ','.join(cluster['splits']) or '-'
+            lines.append(f'  splits={splits}')
+            for key in cluster['keys']:
+                lines.append(
+                    f'    {key if isinstance(key, str) else "|".join(key)}'
+                )
+    return '\n'.join(lines)
@@ -0,0 +1,79 @@
+from typing import Any, Dict, List
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import os
+
+from .database_util import DatabaseConnection
+from .common_util import read_json, sha256_file, write_json
+
+SNAPSHOT_FORMAT_VERSION = 1
+SNAPSHOT_TABLES = ['literatures', 'characters'] # in restoring order
+MANIFEST_FILENAME = 'manifest.json'
+
+def _export_table(
+    db_conn: DatabaseConnection,
+    dirname: str,
+    table_name: str,
+) -> Dict[str, Any]:
+    columns = db_conn.read_column_names(table_name)
+    filename = f'{table_name}.copy.gz'
+    path = os.path.join(dirname, filename)
+    with gzip.open(path, 'wb') as out_f:
+        num_rows = db_conn.copy_table_to_file(table_name, columns, out_f)
+    return {
+        'filename': filename,
+        'columns': columns,
+        'num_rows': num_rows,
+        'sha256': sha256_file(path),
+    }
+
+def export_snapshot(db_conn: DatabaseConnection, dirname: str):
+    # every table is streamed by COPY into its own file on its own connection
+    os.makedirs(dirname, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=len(SNAPSHOT_TABLES)) as executor:
+        futures = {
+            table_name: executor.submit(
+                _export_table, db_conn, dirname, table_name,
+            )
+            for table_name in SNAPSHOT_TABLES
+        }
+        tables = {
+            table_name: future.result()
+            for table_name, future in futures.items()
+        }
+    write_json(os.path.join(dirname, MANIFEST_FILENAME), {
+        'format_version': SNAPSHOT_FORMAT_VERSION,
+        'tables': tables,
+    })
+
+def import_snapshot(db_conn: DatabaseConnection, dirname: str):
+    manifest = read_json(os.path.join(dirname, MANIFEST_FILENAME))
+    if manifest['format_version'] != SNAPSHOT_FORMAT_VERSION:
+        raise ValueError(
+            f'unsupported snapshot format version '
+            f'{manifest["format_version"]}'
+        )
+
+    for table_name in SNAPSHOT_TABLES:
+        table = manifest['tables'][table_name]
+        path = os.path.join(dirname, table['filename'])
+        if sha256_file(path) != table['sha256']:
+            raise ValueError(f'corrupted snapshot file {path}')
+
+    # the tables are restored one after another, since characters references
+    # literatures
+    for table_name in SNAPSHOT_TABLES:
+        table = manifest['tables'][table_name]
+        columns: List[str] = table['columns']
+        with gzip.open(os.path.join(dirname, table['filename']), 'rb') as in_f:
+            num_rows = db_conn.copy_file_to_table(table_name, columns, in_f)
+        # the row counts are -1 when the server does not report them
+        if (
+            num_rows >= 0 and table['num_rows'] >= 0
+            and num_rows != table['num_rows']
+        ):
+            raise ValueError(
+                f'expect {table["num_rows"]} rows in {table_name}, '
+                f'but restored {num_rows}'
+            )
+    db_conn.refresh_materialized_view('book_characters')
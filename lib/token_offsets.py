@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+from typing import Union
+from dataclasses import dataclass, field
+import os
+
+import numpy as np
+
+TOKEN_FIELDS = ('summary', 'description', 'masked_description')
+
+def get_token_offsets_filename(filename: str) -> str:
+    return f'{os.path.splitext(filename)[0]}.tokens.npy'
+
+def get_token_starts(text: str) -> np.ndarray:
+    # the offsets of the tokens of text.split(' '), found without splitting
+    if text.isascii():
+        codes = np.frombuffer(text.encode('ascii'), dtype=np.uint8)
+    else:
+        codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+    spaces = np.flatnonzero(codes == ord(' '))
+    starts = np.empty(len(spaces) + 1, dtype=np.int32)
+    starts[0] = 0
+    starts[1:] = spaces + 1
+    return starts
+
+def write_token_offsets(
+    filename: str,
+    records: Iterable[Tuple[str, ...]],
+):
+    # Writes the token offsets of the TOKEN_FIELDS texts of every record, in
+    # the order of the lines of filename, into one int32 array that can be
+    # memory mapped: the number of records, then the start and end of the
+    # offsets of every text in the rest of the array, then the offsets.
+    # Repeated texts, like the summary of a book, share their offsets.
+    pointers: List[Tuple[int, int]] = []
+    chunks: List[np.ndarray] = []
+    ranges: Dict[str, Tuple[int, int]] = {}
+    size = 0
+    for texts in records:
+        for text in texts:
+            if text not in ranges:
+                starts = get_token_starts(text)
+                chunks.append(starts)
+                ranges[text] = (size, size + len(starts))
+                size += len(starts)
+            pointers.append(ranges[text])
+    if size >= 2**31:
+        raise ValueError('too many tokens for int32 offsets')
+
+    num_records = len(pointers) // len(TOKEN_FIELDS)
+    header = np.array([num_records], dtype=np.int32)
+    pointer_array = np.array(pointers, dtype=np.int32).reshape(-1)
+    np.save(
+        get_token_offsets_filename(filename),
+        np.concatenate([header, pointer_array] + chunks).astype(np.int32),
+    )
+
+class TokenView(Sequence[str]):
+    # The tokens of a text as a sequence that slices a token out of the text
+    # only when it is read, so no list of tokens is built up front. A token
+    # ends before the space in front of the next one.
+    def __init__(self, text: str, starts: np.ndarray):
+        self.text = text
+        self.starts = starts
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def _get_token(self, i: int) -> str:
+        end = (
+            self.starts[i + 1] - 1 if i + 1 < len(self.starts)
+            else len(self.text)
+        )
+        return self.text[self.starts[i]:end]
+
+    def __getitem__(self, i: Union[int, slice]) -> Union[str, List[str]]:
+        if isinstance(i, slice):
+            return [self._get_token(j) for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('token index out of range')
+        return self._get_token(i)
+
+    def __iter__(self) -> Iterator[str]:
+        text = self.text
+        starts = self.starts.tolist()
+        for start, next_start in zip(starts, starts[1:]):
+            yield text[start:next_start - 1]
+        yield text[starts[-1]:]
+
+    def __repr__(self) -> str:
+        return f'TokenView({list(self)!r})'
+
+@dataclass
+class TokenOffsetReader(object):
+    # Memory maps the token offsets of a dataset file, and returns the tokens
+    # of a record as offsets, or as a view of its text, without splitting it.
+    # Records are numbered by their lines in the dataset file.
+    filename: str
+
+    _pointers: Optional[np.ndarray] = field(
+        default=None, init=False, repr=False,
+    )
+    _offsets: Optional[np.ndarray] = field(
+        default=None, init=False, repr=False,
+    )
+
+    def __post_init__(self):
+        data = np.load(
+            get_token_offsets_filename(self.filename), mmap_mode='r',
+        )
+        num_records = int(data[0])
+        end = 1 + num_records * len(TOKEN_FIELDS) * 2
+        self._pointers = data[1:end].reshape(
+            num_records, len(TOKEN_FIELDS), 2,
+        )
+        self._offsets = data[end:]
+
+    def __len__(self) -> int:
+        return len(self._pointers)
+
+    def get_starts(self, record_id: int, field_name: str) -> np.ndarray:
+        start, end = self._pointers[
+            record_id, TOKEN_FIELDS.index(field_name)
+        ]
+        return self._offsets[start:end]
+
+    def get_spans(
+        self,
+        record_id: int,
+        field_name: str,
+        text_length: int,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # the start and end offsets of every token, without the spaces
+        starts = self.get_starts(record_id, field_name)
+        ends = np.empty(len(starts), dtype=np.int32)
+        ends[:-1] = starts[1:] - 1
+        ends[-1] = text_length
+        return starts, ends
+
+    def get_tokens(
+        self,
+        record_id: int,
+        field_name: str,
+        text: str,
+    ) -> TokenView:
+        return TokenView(text, self.get_starts(record_id, field_name))
@@ -1,13 +1,20 @@
 import ast
 import configparser
+import functools
+import itertools
 from typing import final
 from lib.text_diff_tool import TextDiffTool
 import os
 
 from lib.database_util import CharacterInfoWithMaskedDescription, DatabaseConnection
+from lib.database_util import CharacterInfoWithMaskSpans
 from lib.book_char_dataset import BasicBookCharDataset, FinalBookCharDataset
+from lib.book_char_dataset import BookCharPipeline, get_key_str
 from lib.key_translator import KeyTranslator
-from lib.common_util import read_json
+from lib.book_char_subset import BookCharSubset
+from lib.common_util import read_json, write_json, write_indexed_lines
+from lib.common_util import get_shard_sizes, write_jsonl_shards
+from lib.common_util import json_dumps, set_json_backend
 
 _ROOT_DIR = os.path.dirname(os.path.realpath(__file__))
 _STATIC_DIR = os.path.join(_ROOT_DIR, 'static')
@@ -29,7 +36,13 @@ TRAIN_KEY_ORDER_FILENAME = os.path.join(_STATIC_DIR, 'train_keys.txt')
 TEST_KEY_ORDER_FILENAME = os.path.join(_STATIC_DIR, 'test_keys.txt')
 VAL_KEY_ORDER_FILENAME = os.path.join(_STATIC_DIR, 'val_keys.txt')
 
-KEY_TRANSLATOR = KeyTranslator.load_from_json_files(
+SPLIT_KEY_ORDER_FILENAMES = {
+    'train': TRAIN_KEY_ORDER_FILENAME,
+    'test': TEST_KEY_ORDER_FILENAME,
+    'val': VAL_KEY_ORDER_FILENAME,
+}
+
+KEY_MAPPING_FILENAMES = (
     os.path.join(_STATIC_DIR, 'new_book_key_to_old_book_key_mapping.json'),
     os.path.join(_STATIC_DIR, 'old_book_key_to_new_book_key_mapping.json'),
     os.path.join(_STATIC_DIR, 'new_char_key_to_old_char_key_mapping.json'),
@@ -51,88 +64,378 @@ def pre_clean_description(description, char_key):
     
     return description
 
+def clean_description(char_info):
+    char_info.description = pre_clean_description(
+        char_info.description, char_info.char_key
+    )
+    return char_info
+
+def restore_description(change_lookup, char_info):
+    char_info.description = TextDiffTool.restore_text(
+        char_info.description, change_lookup.get(char_info.char_key, [])
+    )
+    return char_info
+
+def restore_summary(change_lookup, book_info):
+    book_info.summary = TextDiffTool.restore_text(
+        book_info.summary, change_lookup.get(book_info.book_key, [])
+    )
+    return book_info
+
+def mask_description(masked_change_lookup, char_info):
+    masked_description = ' '.join(
+        TextDiffTool.restore_list_from_text(
+            char_info.description, masked_change_lookup[char_info.char_key]
+        )
+    )
+    return (
+        CharacterInfoWithMaskedDescription
+            .generate_from_char_info(char_info, masked_description)
+    )
+
+def attach_mask_spans(masked_change_lookup, char_info):
+    # the masking is kept as the changes of the description tokens, and the
+    # masked description is only built when it is read
+    return CharacterInfoWithMaskSpans.generate_from_char_info(
+        char_info, masked_change_lookup[char_info.char_key],
+    )
+
+def load_key_translator(subset=None):
+    return KeyTranslator.load_from_json_files(
+        *KEY_MAPPING_FILENAMES, subset=subset,
+    )
+
+def load_change_lookup(filename, subset=None):
+    changes = read_json(filename)
+    return {
+        ast.literal_eval(key): val
+        for key, val in changes.items()
+        if subset is None or subset.may_contain_key_str(key)
+    }
+
+def load_char_keys(subset=None):
+    list_char_keys = read_json(LIST_CHAR_KEYS_FILENAME)
+    if subset is None:
+        return [ast.literal_eval(char_key) for char_key in list_char_keys]
+    char_keys = [
+        ast.literal_eval(char_key) for char_key in list_char_keys
+        if subset.may_contain_key_str(char_key)
+    ]
+    return [
+        char_key for char_key in char_keys
+        if subset.contains_char_key(char_key)
+    ]
+
+def read_split_char_keys(filename, subset=None):
+    with open(filename) as key_f:
+        char_keys = []
+        for key in key_f.read().splitlines():
+            character_name, book_title, source = key.split('|')
+            char_key = (book_title, source, character_name)
+            if subset is None or subset.contains_char_key(char_key):
+                char_keys.append(char_key)
+        return char_keys
+
+def get_subset_values(config, option):
+    # one value per line, or None to keep everything
+    if not config.has_section('subset'): return None
+    values = config['subset'].get(option, '').splitlines()
+    values = set([value.strip() for value in values if value.strip()])
+    return values if len(values) > 0 else None
+
+def load_subset(config):
+    sources = get_subset_values(config, 'sources')
+    book_titles = get_subset_values(config, 'book_titles')
+    splits = get_subset_values(config, 'splits')
+    char_keys = None
+    if splits is not None:
+        char_keys = set()
+        for split in splits:
+            char_keys.update(
+                read_split_char_keys(SPLIT_KEY_ORDER_FILENAMES[split])
+            )
+    if sources is None and book_titles is None and char_keys is None:
+        return None
+    return BookCharSubset(
+        sources=sources,
+        book_titles=book_titles,
+        char_keys=char_keys,
+    )
+
+def get_outputs(config, subset):
+    # the full output and the selected splits, each with its ordered keys
+    outputs = [(config['output']['filename'], load_char_keys(subset))]
+    selected_splits = get_subset_values(config, 'splits')
+    for split in ['train', 'test', 'val']:
+        if selected_splits is not None and split not in selected_splits:
+            continue
+        outputs.append((
+            config['output'][f'{split}_filename'],
+            read_split_char_keys(SPLIT_KEY_ORDER_FILENAMES[split], subset),
+        ))
+    return outputs
+
+def iter_final_records(
+    db_conn,
+    key_translator,
+    char_keys,
+    from_view,
+    description_change_lookup,
+    summary_change_lookup,
+    masked_change_lookup,
+    mask_spans=False,
+):
+    # applies every step of the in-memory build to one record at a time
+    mask = attach_mask_spans if mask_spans else mask_description
+    char_key_candidates = [
+        key_translator.to_new_char_key_candidates(char_key)
+        for char_key in char_keys
+    ]
+    num_records = 0
+    summary_cache = (None, None)
+    for ordinal, book_info, char_info in (
+        db_conn.iter_book_character_info_in_order(
+            char_key_candidates, from_view=from_view,
+        )
+    ):
+        if ordinal != num_records:
+            raise KeyError(char_keys[num_records])
+        num_records += 1
+
+        char_key = char_keys[ordinal]
+        book_key = char_key[:2]
+        book_info.book_title, book_info.source = book_key
+        (
+            char_info.book_title,
+            char_info.source,
+            char_info.character_name,
+        ) = char_key
+
+        char_info = restore_description(
+            description_change_lookup, clean_description(char_info)
+        )
+        if summary_cache[0] != book_key:
+            summary_cache = (book_key, TextDiffTool.restore_text(
+                book_info.summary, summary_change_lookup.get(book_key, [])
+            ))
+        book_info.summary = summary_cache[1]
+
+        yield FinalBookCharDataset.to_record(
+            book_info, mask(masked_change_lookup, char_info),
+        )
+    if num_records != len(char_keys):
+        raise KeyError(char_keys[num_records])
+
+def get_compression(config):
+    # plain jsonl files without a compression, otherwise compressed shards
+    compression = config['output'].get('compression', '') or None
+    return compression, config['output'].getint('num_shards', fallback=1)
+
+def get_mask_spans(config):
+    # whether the outputs have mask spans instead of masked descriptions
+    return config.getboolean('output', 'mask_spans', fallback=False)
+
+def build_streaming(config, db_conn, subset):
+    # every output is written by its own pass over a database cursor that
+    # returns the records in output order, so no dataset is kept in memory
+    from_view = config['database'].getboolean(
+        'use_export_view', fallback=False,
+    )
+    key_translator = load_key_translator(subset)
+    description_change_lookup = load_change_lookup(
+        DESCRIPTION_CHANGES_FILENAME, subset
+    )
+    summary_change_lookup = load_change_lookup(
+        SUMMARY_CHANGES_FILENAME, subset
+    )
+    masked_change_lookup = load_change_lookup(
+        MASKED_DESCRIPTION_CHANGES_FILENAME, subset
+    )
+
+    compression, num_shards = get_compression(config)
+
+    with db_conn:
+        for filename, char_keys in get_outputs(config, subset):
+            records = iter_final_records(
+                db_conn,
+                key_translator,
+                char_keys,
+                from_view,
+                description_change_lookup,
+                summary_change_lookup,
+                masked_change_lookup,
+                get_mask_spans(config),
+            )
+            lines = (json_dumps(record) + '\n' for record in records)
+            if compression is None:
+                write_indexed_lines(filename, (
+                    (get_key_str(char_key), (line,))
+                    for char_key, line in zip(char_keys, lines)
+                ))
+                continue
+            # the shards are consecutive slices of the one cursor, so they
+            # are written one after another
+            write_jsonl_shards(filename, [
+                itertools.islice(lines, size)
+                for size in get_shard_sizes(len(char_keys), num_shards)
+            ], compression, max_workers=1)
+
 def load_config():
     config = configparser.ConfigParser()
     config.read(RUNTIME_CONFIG_FILENAME)
     return config
 
-def main():
-    config = load_config()
-    db_conn = DatabaseConnection(
+def load_database_connection(config):
+    return DatabaseConnection(
         host=config['database']['host'],
         user=config['database']['user'],
         password=config['database']['password'],
         dbname=config['database']['dbname'],
     )
-    dataset = BasicBookCharDataset.load_from_database(db_conn)
-
-    dataset.replace_keys(
-        KEY_TRANSLATOR.new_to_old_book_key_mapping,
-        KEY_TRANSLATOR.new_to_old_char_key_mapping,
-    )
 
-    list_char_keys = read_json(LIST_CHAR_KEYS_FILENAME)
-    char_keys = [ast.literal_eval(char_key) for char_key in list_char_keys]
-    dataset.filter_by_char_keys(char_keys)
+def build_incremental(config, db_conn, subset, row_version):
+    # only the records whose rows changed after row_version are rebuilt, and
+    # their lines are replaced in the existing outputs
+    key_translator = load_key_translator(subset)
+    with db_conn:
+        changed_char_keys = db_conn.read_changed_char_keys(row_version)
+    changed_char_keys = set([
+        key_translator.new_to_old_char_key_mapping.get(char_key, char_key)
+        for char_key in changed_char_keys
+    ])
+    outputs = get_outputs(config, subset)
+    char_keys = [
+        char_key for char_key in outputs[0][1]
+        if char_key in changed_char_keys
+    ]
+    if len(char_keys) == 0: return
 
-    for char_key, char_info in dataset.char_lookup.items():
-        char_info.description = pre_clean_description(
-            char_info.description, char_key
-        )
+    with db_conn:
+        records = list(iter_final_records(
+            db_conn,
+            key_translator,
+            char_keys,
+            config['database'].getboolean('use_export_view', fallback=False),
+            load_change_lookup(DESCRIPTION_CHANGES_FILENAME, subset),
+            load_change_lookup(SUMMARY_CHANGES_FILENAME, subset),
+            load_change_lookup(MASKED_DESCRIPTION_CHANGES_FILENAME, subset),
+            get_mask_spans(config),
+        ))
+    for filename, _ in outputs:
+        FinalBookCharDataset.patch_jsonl(filename, records)
 
-    description_changes = read_json(DESCRIPTION_CHANGES_FILENAME)
-    change_lookup = {
-        ast.literal_eval(key): val
-        for key, val in description_changes.items()
-    }
-    dataset.adjust_description(change_lookup)
+def get_state_filename(config):
+    return config['output'].get(
+        'state_filename',
+        os.path.join(
+            os.path.dirname(config['output']['filename']),
+            'export_state.json',
+        ),
+    )
 
-    summary_changes = read_json(SUMMARY_CHANGES_FILENAME)
-    change_lookup = {
-        ast.literal_eval(key): val
-        for key, val in summary_changes.items()
-    }
-    dataset.adjust_summary(change_lookup)
+def load_pipeline(subset, mask_spans=False):
+    return (
+        BookCharPipeline()
+        .add_book_stage('restore_summary', functools.partial(
+            restore_summary,
+            load_change_lookup(SUMMARY_CHANGES_FILENAME, subset),
+        ))
+        .add_char_stage('pre_clean_description', clean_description)
+        .add_char_stage('restore_description', functools.partial(
+            restore_description,
+            load_change_lookup(DESCRIPTION_CHANGES_FILENAME, subset),
+        ))
+        .add_char_stage('mask_description', functools.partial(
+            attach_mask_spans if mask_spans else mask_description,
+            load_change_lookup(MASKED_DESCRIPTION_CHANGES_FILENAME, subset),
+        ))
+    )
 
-    masked_description_changes = read_json(MASKED_DESCRIPTION_CHANGES_FILENAME)
-    masked_change_lookup = {
-        ast.literal_eval(key): val
-        for key, val in masked_description_changes.items()
-    }
-    new_char_infos = []
-    for char_key, char_info in dataset.char_lookup.items():
-        changes = masked_change_lookup[char_key]
-        masked_description = ' '.join(
-            TextDiffTool.restore_list_from_text(
-                char_info.description, changes
+def build(config, db_conn, subset):
+    if config.getboolean('build', 'streaming', fallback=False):
+        if (
+            config['output'].get('columnar_dirname', '')
+            or config.getboolean('output', 'token_offsets', fallback=False)
+        ):
+            raise ValueError(
+                'the columnar and token offset exports need the in-memory '
+                'build'
             )
+        build_streaming(config, db_conn, subset)
+        return
+
+    key_translator = load_key_translator(subset)
+    outputs = get_outputs(config, subset)
+    char_keys = outputs[0][1]
+    book_keys = list(set([(title, source) for title, source, _ in char_keys]))
+
+    # only load the rows whose translated keys are listed
+    with db_conn:
+        dataset = BasicBookCharDataset.load_from_database(
+            db_conn,
+            book_keys=key_translator.to_new_book_keys(book_keys),
+            char_keys=key_translator.to_new_char_keys(char_keys),
+            from_view=config['database'].getboolean(
+                'use_export_view', fallback=False,
+            ),
         )
-        new_char_info = (
-            CharacterInfoWithMaskedDescription
-                .generate_from_char_info(char_info, masked_description)
-        )
-        new_char_infos.append(new_char_info)
-    final_dataset = FinalBookCharDataset(
-        books=list(dataset.book_lookup.values()),
-        characters=new_char_infos,
+
+    # every record goes through the key translation and all stages once
+    pipeline = load_pipeline(subset, get_mask_spans(config))
+    books, characters = pipeline.run(
+        dataset,
+        key_translator.new_to_old_book_key_mapping,
+        key_translator.new_to_old_char_key_mapping,
+        char_keys,
+        num_workers=config.getint('build', 'workers', fallback=1),
     )
+    print(pipeline.format_timings())
+    final_dataset = FinalBookCharDataset(books=books, characters=characters)
 
-    final_dataset.export_to_jsonl(config['output']['filename'])
+    compression, num_shards = get_compression(config)
+    final_dataset.export_to_jsonl_files(outputs[0][0], {
+        filename: list(map(get_key_str, split_char_keys))
+        for filename, split_char_keys in outputs[1:]
+    }, compression=compression, num_shards=num_shards, token_offsets=(
+        config.getboolean('output', 'token_offsets', fallback=False)
+    ))
 
-    with open(TRAIN_KEY_ORDER_FILENAME) as train_key_f:
-        train_keys = list(train_key_f.read().splitlines())
-        final_dataset.export_to_jsonl_with_selected_keys(
-            config['output']['train_filename'], train_keys)
+    columnar_dirname = config['output'].get('columnar_dirname', '')
+    if columnar_dirname:
+        final_dataset.export_to_columnar(columnar_dirname)
+
+def main():
+    config = load_config()
+    json_backend = config.get('build', 'json_backend', fallback='')
+    if json_backend:
+        set_json_backend(json_backend)
+    db_conn = load_database_connection(config)
+    subset = load_subset(config)
+    if not config.getboolean('build', 'incremental', fallback=False):
+        build(config, db_conn, subset)
+        return
+    if get_compression(config)[0] is not None:
+        raise ValueError('incremental builds only patch uncompressed outputs')
+    if (
+        config['output'].get('columnar_dirname', '')
+        or config.getboolean('output', 'token_offsets', fallback=False)
+    ):
+        raise ValueError(
+            'incremental builds do not patch columnar or token offset outputs'
+        )
 
-    with open(TEST_KEY_ORDER_FILENAME) as test_key_f:
-        test_keys = list(test_key_f.read().splitlines())
-        final_dataset.export_to_jsonl_with_selected_keys(
-            config['output']['test_filename'], test_keys)
+    # the watermark is read before the export, so rows changed during the
+    # export are exported again by the next run
+    state_filename = get_state_filename(config)
+    with db_conn:
+        row_version = db_conn.read_max_row_version()
+    if os.path.exists(state_filename):
+        build_incremental(
+            config, db_conn, subset, read_json(state_filename)['row_version'],
+        )
+    else:
+        build(config, db_conn, subset)
+    write_json(state_filename, {'row_version': row_version})
 
-    with open(VAL_KEY_ORDER_FILENAME) as val_key_f:
-        val_keys = list(val_key_f.read().splitlines())
-        final_dataset.export_to_jsonl_with_selected_keys(
-            config['output']['val_filename'], val_keys)
-    
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,63 @@
+import argparse
+
+from lib.book_char_dataset import FinalBookCharDataset, get_key_str
+from lib.common_util import write_json
+from lib.near_duplicates import format_near_duplicates, report_near_duplicates
+from main import SPLIT_KEY_ORDER_FILENAMES, load_config, read_split_char_keys
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description='Report the near-duplicate descriptions and summaries '
+        'of an exported dataset file'
+    )
+    parser.add_argument(
+        'filename', type=str, nargs='?', default=None,
+        help='the dataset file, by default the full output of runtime.ini',
+    )
+    parser.add_argument(
+        '--threshold', type=float, default=0.8,
+        help='minimum estimated Jaccard similarity of near duplicates',
+    )
+    parser.add_argument(
+        '--num_perm', type=int, default=128,
+        help='number of hashes of a MinHash signature',
+    )
+    parser.add_argument(
+        '--num_bands', type=int, default=16,
+        help='number of LSH bands, a divisor of num_perm',
+    )
+    parser.add_argument(
+        '--shingle_size', type=int, default=3,
+        help='number of words of a shingle',
+    )
+    parser.add_argument(
+        '--output', type=str, default=None,
+        help='json file to write every cluster to',
+    )
+    parser.add_argument(
+        '--verbose', action='store_true',
+        help='whether to print every cluster, not only those across splits',
+    )
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    filename = args.filename or load_config()['output']['filename']
+    split_keys = {
+        split: list(map(get_key_str, read_split_char_keys(key_filename)))
+        for split, key_filename in SPLIT_KEY_ORDER_FILENAMES.items()
+    }
+    report = report_near_duplicates(
+        FinalBookCharDataset.load_from_jsonl(filename),
+        split_keys,
+        threshold=args.threshold,
+        num_perm=args.num_perm,
+        num_bands=args.num_bands,
+        shingle_size=args.shingle_size,
+    )
+    if args.output is not None:
+        write_json(args.output, report)
+    print(format_near_duplicates(report, verbose=args.verbose))
+
+if __name__ == '__main__':
+    main()
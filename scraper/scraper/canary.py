@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""Canary crawl that checks the selectors on a sample of every source"""
+
+from collections import defaultdict
+from urllib.parse import urlparse
+import random
+import re
+
+
+def get_source_host(url):
+    """
+    Return the host of the archived page of a Wayback Machine url, e.g.
+    `www.sparknotes.com`, or None if the url is not an archived page.
+    """
+    result = re.search(r'^https?:\/\/web.archive.org\/web\/\d{14}\/(.*)$', url)
+    if result is None: return None
+    return urlparse(result.group(1)).netloc.lower()
+
+
+class CanaryMonitor(object):
+    """
+    Sample the urls of a crawl per source host and keep the yield rate of
+    every extracted field per source host. A sample size of 0 disables the
+    canary mode, in which case all urls are kept and nothing is recorded.
+    Every expected field of a sampled host must be observed, so a field
+    whose selector never matches on the page fails too.
+    """
+
+    def __init__(
+        self, sample_size=0, min_yield_rate=0.9, seed=0, expected_fields=(),
+    ):
+        self.sample_size = sample_size
+        self.min_yield_rate = min_yield_rate
+        self.seed = seed
+        self.expected_fields = tuple(expected_fields)
+        self.sampled_hosts = set()
+        # host -> field -> [hits, observations]
+        self.counts = defaultdict(lambda: defaultdict(lambda: [0, 0]))
+
+    @classmethod
+    def from_settings(cls, settings, expected_fields=()):
+        return cls(
+            sample_size=settings.getint('CANARY_SAMPLE_SIZE'),
+            min_yield_rate=settings.getfloat('CANARY_MIN_YIELD_RATE'),
+            seed=settings.getint('CANARY_SEED'),
+            expected_fields=expected_fields,
+        )
+
+    @property
+    def enabled(self):
+        return self.sample_size > 0
+
+    def sample(self, urls):
+        if not self.enabled: return urls
+
+        urls_by_host = defaultdict(list)
+        for url in urls:
+            urls_by_host[get_source_host(url)].append(url)
+
+        rng = random.Random(self.seed)
+        sampled_urls = []
+        for host in sorted(urls_by_host, key=str):
+            host_urls = urls_by_host[host]
+            size = min(self.sample_size, len(host_urls))
+            sampled_urls += rng.sample(host_urls, size)
+            self.sampled_hosts.add(host)
+        return sampled_urls
+
+    def observe(self, url, field, value):
+        """Record whether `field` was found on the page and return `value`"""
+        if self.enabled:
+            count = self.counts[get_source_host(url)][field]
+            count[0] += int(bool(value))
+            count[1] += 1
+        return value
+
+    def get_counts(self):
+        """Return the counts of every observed or expected field per host"""
+        counts = {}
+        for host in sorted(self.sampled_hosts | set(self.counts), key=str):
+            counts[host] = {
+                field: (0, 0) for field in self.expected_fields
+            }
+            for field, (hits, total) in self.counts[host].items():
+                counts[host][field] = (hits, total)
+        return counts
+
+    def failures(self):
+        return [
+            (host, field)
+            for host, fields in self.get_counts().items()
+            for field, (hits, total) in fields.items()
+            if total == 0 or hits < self.min_yield_rate * total
+        ]
+
+    def passed(self):
+        return len(self.failures()) == 0
+
+    def report(self):
+        failures = set(self.failures())
+        lines = ['PASSED' if len(failures) == 0 else 'FAILED']
+        for host, fields in self.get_counts().items():
+            for field, (hits, total) in fields.items():
+                status = 'FAIL' if (host, field) in failures else 'ok'
+                rate = hits / total if total > 0 else 0
+                lines.append(
+                    f'{host} {field}: {hits}/{total} ({rate:.1%}) {status}'
+                )
+        return '\n'.join(lines)
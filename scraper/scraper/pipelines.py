@@ -52,14 +52,35 @@ class DatabaseConnection(object):
         value_list = ','.join(['%s' for _ in vals])
         conflict_targets = ','.join(prim_keys)
         overwrites = ','.join([f'{key} = EXCLUDED.{key}' for key in opt_keys])
-
+        # unchanged rows are not updated, so their row_version stays the same
+        old_values = ','.join([f'{table_name}.{key}' for key in opt_keys])
+        new_values = ','.join([f'EXCLUDED.{key}' for key in opt_keys])
+
+        on_conflict = (
+            f'DO UPDATE SET {overwrites} '
+            f'WHERE ({old_values}) IS DISTINCT FROM ({new_values})'
+            if len(opt_keys) > 0
+            else 'DO NOTHING'
+        )
         query = (
             f'INSERT INTO {table_name} ({column_list}) VALUES ({value_list}) '
             f'ON CONFLICT ({conflict_targets}) '
-            f'DO UPDATE SET {overwrites};'
+            f'{on_conflict};'
         )
 
-        self.cur.execute(query, vals)
+        try:
+            self.cur.execute(query, vals)
+        except psycopg2.Error:
+            # an aborted transaction would fail every later statement
+            self.conn.rollback()
+            raise
+        self.conn.commit()
+
+    def refresh_materialized_view(self, view_name):
+        # databases created before the view was added do not have it
+        self.cur.execute('SELECT to_regclass(%s);', (view_name,))
+        if self.cur.fetchone()[0] is None: return
+        self.cur.execute(f'REFRESH MATERIALIZED VIEW {view_name};')
         self.conn.commit()
 
     def read(self, table_name, primary_fields, target_keys):
@@ -79,11 +100,26 @@ class DatabaseConnection(object):
 
 class LCDataScraperPipeline(object):
     _db: DatabaseConnection
+    _skipped_fields: set = set()
+    _canary: bool = False
+
+    def open_spider(self, spider):
+        self._skipped_fields = (
+            set(spider.settings.getlist('SKIPPED_ITEM_FIELDS'))
+            - set(LIT_PRIMS) - set(CHAR_PRIMS)
+        )
+        # the rows of a canary crawl are a sample, so they are not written
+        self._canary = spider.settings.getint('CANARY_SAMPLE_SIZE') > 0
 
     def close_spider(self, spider):
+        if self._canary: return
+        self._db.refresh_materialized_view('book_characters')
         self._db.close()
 
     def process_item(self, item, spider):
+        if self._canary:
+            return item
+
         if isinstance(item, LiteratureInfo):
             self.process_literature_info(item)
 
@@ -96,7 +132,11 @@ class LCDataScraperPipeline(object):
         data = list(item.items())
         primary_fields = list(filter(lambda e: e[0] in LIT_PRIMS, data))
         primary_fields = {key: val for key, val in primary_fields}
-        optional_fields = list(filter(lambda e: e[0] not in LIT_PRIMS, data))
+        optional_fields = list(filter(
+            lambda e: e[0] not in LIT_PRIMS
+                and e[0] not in self._skipped_fields,
+            data,
+        ))
         optional_fields = {key: val for key, val in optional_fields}
         self._db.write(
             table_name='literatures',
@@ -108,7 +148,11 @@ class LCDataScraperPipeline(object):
         data = list(item.items())
         primary_fields = list(filter(lambda e: e[0] in CHAR_PRIMS, data))
         primary_fields = {key: val for key, val in primary_fields}
-        optional_fields = list(filter(lambda e: e[0] not in CHAR_PRIMS, data))
+        optional_fields = list(filter(
+            lambda e: e[0] not in CHAR_PRIMS
+                and e[0] not in self._skipped_fields,
+            data,
+        ))
         optional_fields = {key: val for key, val in optional_fields}
         self._db.write(
             table_name='characters',
@@ -118,6 +162,8 @@ class LCDataScraperPipeline(object):
 
 class LCDataScraperDatabasePipeline(LCDataScraperPipeline):
     def open_spider(self, spider):
+        super().open_spider(spider)
+        if self._canary: return
         config = load_config()
         self._db = DatabaseConnection(
             host=config['database']['host'],
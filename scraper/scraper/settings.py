@@ -13,6 +13,18 @@ SPIDER_MODULES = ['scraper.spiders']
 NEWSPIDER_MODULE = 'scraper.spiders'
 
 
+# Item fields that the spiders neither extract nor store, e.g.
+# ['analysis_url', 'analysis_text']. Primary key fields are always kept.
+# Leave empty for a full-fidelity crawl.
+SKIPPED_ITEM_FIELDS = []
+
+# Canary mode: crawl only CANARY_SAMPLE_SIZE randomly sampled urls per source
+# host and fail if any field is found on less than CANARY_MIN_YIELD_RATE of
+# the sampled pages. A sample size of 0 runs the full crawl.
+CANARY_SAMPLE_SIZE = 0
+CANARY_MIN_YIELD_RATE = 0.9
+CANARY_SEED = 0
+
 # Crawl responsibly by identifying yourself (and your website) on the user-agent
 #USER_AGENT = 'scraper (+http://www.yourdomain.com)'
 
@@ -6,6 +6,7 @@ import re, string, json, os
 from scraper.items import CharacterInfo
 from scraper.utils import extract_paragraphs, extract_text
 from scraper.utils import clean_text_or_none, remove_html_tags
+from scraper.canary import CanaryMonitor
 from scrapy.utils.log import configure_logging
 
 
@@ -21,6 +22,9 @@ LITCHARTS_ADJUSTMENT_FILENAME = os.path.join(_STATIC_DIR, 'litcharts_adjustment.
 
 INPUT_URLS_FILENAME = os.path.join(_INPUT_DIR, 'list_characters_retry.txt')
 OUTPUT_URLS_FILENAME = os.path.join(_OUTPUT_DIR, 'list_characters_failed.txt')
+CANARY_REPORT_FILENAME = os.path.join(
+    _OUTPUT_DIR, 'wayback_char_canary_report.txt',
+)
 
 LOG_PATH = os.path.join(_OUTPUT_DIR, 'wayback_char_runtime.log')
 
@@ -38,6 +42,8 @@ logger.addHandler(_ch)
 class WaybackCharSpider(Spider):
     name = 'wayback_char'
     allowed_domains = ['web.archive.org']
+    # every page of a sampled source must yield these fields
+    canary_fields = ('page', 'title', 'description')
     custom_settings = {
         'DOWNLOAD_DELAY': 0.5,
         'ITEM_PIPELINES': {
@@ -49,6 +55,12 @@ class WaybackCharSpider(Spider):
     def from_crawler(cls, crawler, *args, **kwargs):
         spider = super(WaybackCharSpider, cls).from_crawler(crawler, *args, **kwargs)
         crawler.signals.connect(spider.spider_closed, signal=signals.spider_closed)
+        spider.canary = CanaryMonitor.from_settings(
+            crawler.settings, cls.canary_fields,
+        )
+        spider.skipped_fields = set(
+            crawler.settings.getlist('SKIPPED_ITEM_FIELDS'),
+        )
         return spider
 
     def start_requests(self):
@@ -71,6 +83,7 @@ class WaybackCharSpider(Spider):
         
         self.failed_urls = set()
         
+        urls = self.canary.sample(urls)
         for url in urls:
             yield Request(
                 url=url,
@@ -79,6 +92,14 @@ class WaybackCharSpider(Spider):
             )
 
     def spider_closed(self, spider):
+        # a canary crawl must not overwrite the failed urls of a full one
+        if self.canary.enabled:
+            report = self.canary.report()
+            logger.info(f'Canary report:\n{report}')
+            with open(CANARY_REPORT_FILENAME, 'w') as out_f:
+                out_f.write(report+'\n')
+            return
+
         with open(OUTPUT_URLS_FILENAME, 'w') as out_f:
             for url in self.failed_urls:
                 out_f.write(url+'\n')
@@ -93,6 +114,9 @@ class WaybackCharSpider(Spider):
     def validate_response(self, response, orig_url):
         orig_base_url = self.get_base_url(orig_url)
         response_base_url = self.get_base_url(response.url)
+        self.canary.observe(
+            orig_url, 'page', orig_base_url == response_base_url,
+        )
         if orig_base_url != response_base_url:
             logger.error(f'expect {orig_url}, but got {response.url}')
             self.failed_urls.add(orig_url)
@@ -122,6 +146,7 @@ class WaybackCharSpider(Spider):
         # get book title
         title = response.css('h1.TitleHeader_title::text').get()
         title = clean_text_or_none(title)
+        self.canary.observe(response.url, 'title', title)
         if title is None:
             logger.error(f'Missing book title - {response.url}')
             return
@@ -134,6 +159,7 @@ class WaybackCharSpider(Spider):
             paragraphs = selector.xpath(f'./p/text()').extract()
             cdescription_text = ' '.join(map(remove_html_tags, paragraphs))
             cdescription_text = clean_text_or_none(cdescription_text)
+            self.canary.observe(response.url, 'description', cdescription_text)
 
             if (
                 cname == 'Unnamed narrator' and
@@ -159,6 +185,7 @@ class WaybackCharSpider(Spider):
         # get book title
         title = response.css('div.title-wrapper > h1::text').get()
         title = clean_text_or_none(title)
+        self.canary.observe(response.url, 'title', title)
         if title is None:
             logger.error(f'Missing book title - {url}')
             return
@@ -191,6 +218,7 @@ class WaybackCharSpider(Spider):
             description = map(remove_html_tags, description_node.extract())
             description = ' '.join(description)
             description = clean_text_or_none(description)
+            self.canary.observe(response.url, 'description', description)
             logger.debug(description)
 
             yield CharacterInfo(
@@ -214,15 +242,19 @@ class WaybackCharSpider(Spider):
             logger.error(f'No character description - {response.url}')
             cdescription_text = None
 
-        canalysis = response.xpath(
-            '//div[@class="content-wrapper"]/div[2]/p',
-        ).extract()
-        canalysis_text = ' '.join('\n'.join(
-            map(remove_html_tags, canalysis),
-        ).split())
-        if len(canalysis_text) == 0:
-            logger.error(f'No character analysis - {response.url}')
-            canalysis_text = None
+        # the analysis covers the whole page, so skip it when it is projected
+        # out of the crawl
+        canalysis_text = None
+        if 'analysis_text' not in self.skipped_fields:
+            canalysis = response.xpath(
+                '//div[@class="content-wrapper"]/div[2]/p',
+            ).extract()
+            canalysis_text = ' '.join('\n'.join(
+                map(remove_html_tags, canalysis),
+            ).split())
+            if len(canalysis_text) == 0:
+                logger.error(f'No character analysis - {response.url}')
+                canalysis_text = None
 
         return [{
             'name': character_name,
@@ -296,6 +328,7 @@ class WaybackCharSpider(Spider):
         # get book title
         title = self.shmoop_find_correct_title(response)
         title = clean_text_or_none(title)
+        self.canary.observe(response.url, 'title', title)
         if title is None:
             logger.error(f'Missing book title - {response.url}')
             return
@@ -309,13 +342,16 @@ class WaybackCharSpider(Spider):
             characters = self.__parse_shmoop_major_char(response, cname)
 
         for character in characters:
+            self.canary.observe(
+                response.url, 'description', character['description_text'],
+            )
             if (
                 character['description_text']
                     .startswith(
                         'George Hurstwood Jr. is Hurstwood\'s son.'
                     )
             ): continue
-            yield CharacterInfo(
+            char_info = CharacterInfo(
                 character_name=character['name'],
                 book_title=title,
                 source='shmoop',
@@ -325,18 +361,21 @@ class WaybackCharSpider(Spider):
                     else None
                 ),
                 description_text=character['description_text'],
-                analysis_url=(
+            )
+            if 'analysis_text' not in self.skipped_fields:
+                char_info['analysis_url'] = (
                     response.url
                     if character['analysis_text'] is not None
                     else None
-                ),
-                analysis_text=character['analysis_text'],
-            )
+                )
+                char_info['analysis_text'] = character['analysis_text']
+            yield char_info
 
     def parse_litcharts_major_char(self, response):
         # get book title
         title = response.css('h2.book-title::text').get()
         title = clean_text_or_none(title)
+        self.canary.observe(response.url, 'title', title)
         if title is None:
             logger.error(f'Missing book title - {response.url}')
             return
@@ -353,12 +392,14 @@ class WaybackCharSpider(Spider):
             '//div[@class="highlightable-content"]',
         ).extract()
         if len(paragraphs) == 0:
+            self.canary.observe(response.url, 'description', None)
             logger.error(
                 f'No description for {response.url}',
             )
             return
         description_text = ' '.join(map(remove_html_tags, paragraphs))
         description_text = clean_text_or_none(description_text)
+        self.canary.observe(response.url, 'description', description_text)
 
         char_info = CharacterInfo(
             character_name=char_name,
@@ -379,6 +420,7 @@ class WaybackCharSpider(Spider):
         # get book title
         title = response.css('h2.book-title::text').get()
         title = clean_text_or_none(title)
+        self.canary.observe(response.url, 'title', title)
         if title is None:
             logger.error(f'Missing book title - {response.url}')
             return
@@ -399,12 +441,14 @@ class WaybackCharSpider(Spider):
             classes = 'no-inline-characters no-inline-symbols no-inline-terms'
             paragraphs = node.xpath(f'.//div[@class="{classes}"]').extract()
             if len(paragraphs) == 0:
+                self.canary.observe(response.url, 'description', None)
                 logger.error(
                     f'No description for minor character {name} - {response.url}',
                 )
                 continue
             description_text = ' '.join(map(remove_html_tags, paragraphs))
             description_text = clean_text_or_none(description_text)
+            self.canary.observe(response.url, 'description', description_text)
             yield CharacterInfo(
                 character_name=name,
                 book_title=title,
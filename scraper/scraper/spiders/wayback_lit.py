@@ -5,6 +5,7 @@ import os, re
 
 from scraper.items import LiteratureInfo
 from scraper.utils import clean_text_or_none, remove_html_tags
+from scraper.canary import CanaryMonitor
 from scrapy.utils.log import configure_logging
 
 _ROOT_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -16,6 +17,9 @@ ALL_URLS_FILENAME = os.path.join(_STATIC_DIR, 'list_literatures_cached.txt')
 
 INPUT_URLS_FILENAME = os.path.join(_INPUT_DIR, 'list_literatures_retry.txt')
 OUTPUT_URLS_FILENAME = os.path.join(_OUTPUT_DIR, 'list_literatures_failed.txt')
+CANARY_REPORT_FILENAME = os.path.join(
+    _OUTPUT_DIR, 'wayback_lit_canary_report.txt',
+)
 
 LOG_PATH = os.path.join(_OUTPUT_DIR, 'wayback_lit_runtime.log')
 
@@ -33,6 +37,8 @@ logger.addHandler(_ch)
 class WaybackLitSpider(Spider):
     name = 'wayback_lit'
     allowed_domains = ['web.archive.org']
+    # every page of a sampled source must yield these fields
+    canary_fields = ('page', 'title', 'author', 'summary')
     custom_settings = {
         'DOWNLOAD_DELAY': 0.5,
         'ITEM_PIPELINES': {
@@ -44,6 +50,9 @@ class WaybackLitSpider(Spider):
     def from_crawler(cls, crawler, *args, **kwargs):
         spider = super(WaybackLitSpider, cls).from_crawler(crawler, *args, **kwargs)
         crawler.signals.connect(spider.spider_closed, signal=signals.spider_closed)
+        spider.canary = CanaryMonitor.from_settings(
+            crawler.settings, cls.canary_fields,
+        )
         return spider
 
     def start_requests(self):
@@ -65,11 +74,20 @@ class WaybackLitSpider(Spider):
 
         self.failed_urls = set()
 
+        urls = self.canary.sample(urls)
         for url in urls:
             yield Request(url=url, callback=self.validate_response, cb_kwargs={'orig_url': url})
 
     def spider_closed(self, spider):
         self.crawler.stats.set_value('failed_urls', ', '.join(self.failed_urls))
+        # a canary crawl must not overwrite the failed urls of a full one
+        if self.canary.enabled:
+            report = self.canary.report()
+            logger.info(f'Canary report:\n{report}')
+            with open(CANARY_REPORT_FILENAME, 'w') as out_f:
+                out_f.write(report+'\n')
+            return
+
         with open(OUTPUT_URLS_FILENAME, 'w') as out_f:
             for url in self.failed_urls:
                 out_f.write(url+'\n')
@@ -84,6 +102,9 @@ class WaybackLitSpider(Spider):
     def validate_response(self, response, orig_url):
         orig_base_url = self.get_base_url(orig_url)
         response_base_url = self.get_base_url(response.url)
+        self.canary.observe(
+            orig_url, 'page', orig_base_url == response_base_url,
+        )
         if orig_base_url != response_base_url:
             logger.error(f'expect {orig_url}, but got {response.url}')
             self.failed_urls.add(orig_url)
@@ -117,6 +138,7 @@ class WaybackLitSpider(Spider):
     def parse_sparknotes_lit(self, response):
         # get book title
         title = response.css('h1.TitleHeader_title::text').get()
+        self.canary.observe(response.url, 'title', title)
         if title is None:
             logger.error(f'Missing book title - {response.url}')
             self.failed_urls.add(response.url)
@@ -131,6 +153,7 @@ class WaybackLitSpider(Spider):
                 'a.TitleHeader_authorLink::text',
             ],
         )
+        self.canary.observe(response.url, 'author', author)
         if author is None:
             logger.error(f'Missing author name - {response.url}')
             self.failed_urls.add(response.url)
@@ -139,6 +162,7 @@ class WaybackLitSpider(Spider):
         paragraphs = response.xpath('//*[@id="plotoverview"]/p/text()').extract()
         summary_text = ' '.join(map(remove_html_tags, paragraphs))
         summary_text = clean_text_or_none(summary_text)
+        self.canary.observe(response.url, 'summary', summary_text)
         if summary_text is None:
             logger.error(f'Missing summary - {response.url}')
             self.failed_urls.add(response.url)
@@ -155,6 +179,7 @@ class WaybackLitSpider(Spider):
     def parse_cliffnotes_lit(self, response):
         # get book title
         title = response.css('div.title-wrapper > h1::text').get()
+        self.canary.observe(response.url, 'title', title)
         if title is None:
             logger.error(f'Missing book title - {response.url}')
             self.failed_urls.add(response.url)
@@ -163,6 +188,7 @@ class WaybackLitSpider(Spider):
 
         # get book author
         author = response.css('div.title-wrapper > h2::text').get()
+        self.canary.observe(response.url, 'author', author)
         if author is None:
             logger.error(f'Missing author name - {response.url}')
             self.failed_urls.add(response.url)
@@ -173,6 +199,7 @@ class WaybackLitSpider(Spider):
         paragraphs = response.css('p.litNoteText').extract()
         summary_text = ' '.join(map(remove_html_tags, paragraphs))
         summary_text = clean_text_or_none(summary_text)
+        self.canary.observe(response.url, 'summary', summary_text)
         if summary_text is None:
             logger.error(f'Missing summary - {response.url}')
             self.failed_urls.add(response.url)
@@ -190,6 +217,7 @@ class WaybackLitSpider(Spider):
         # get book title
         title = response.css('ul.items > li:nth-child(4) > a::text').get()
         title = clean_text_or_none(title)
+        self.canary.observe(response.url, 'title', title)
         if title is None:
             logger.error(f'Missing book title - {response.url}')
             self.failed_urls.add(response.url)
@@ -198,6 +226,7 @@ class WaybackLitSpider(Spider):
         # get book author
         author = response.css('span.author-name::text').get()
         author = clean_text_or_none(author)
+        self.canary.observe(response.url, 'author', author)
         if author is None:
             logger.error(f'Missing author name - {response.url}')
             self.failed_urls.add(response.url)
@@ -213,6 +242,7 @@ class WaybackLitSpider(Spider):
             ).extract()
         summary_text = ' '.join(map(remove_html_tags, summary))
         summary_text = clean_text_or_none(summary_text)
+        self.canary.observe(response.url, 'summary', summary_text)
         if summary_text is None:
             logger.error(f'Missing summary - {response.url}')
             self.failed_urls.add(response.url)
@@ -229,6 +259,7 @@ class WaybackLitSpider(Spider):
     def parse_litcharts_lit(self, response):
         # get book title
         title = response.css('h2.book-title::text').get()
+        self.canary.observe(response.url, 'title', title)
         if title is None:
             logger.error(f'Missing book title - {response.url}')
             self.failed_urls.add(response.url)
@@ -237,6 +268,7 @@ class WaybackLitSpider(Spider):
 
         # get book author
         author = response.css('span.book-author > h3.inline::text').get()
+        self.canary.observe(response.url, 'author', author)
         if author is None:
             logger.error(f'Missing author name - {response.url}')
             self.failed_urls.add(response.url)
@@ -246,11 +278,13 @@ class WaybackLitSpider(Spider):
         # get summary
         paragraphs = response.xpath('//p[@class="plot-text"]').extract()
         if len(paragraphs) == 0:
+            self.canary.observe(response.url, 'summary', None)
             logger.error(f'No summary for {response.url}')
             self.failed_urls.add(response.url)
             return
         summary_text = ' '.join(map(remove_html_tags, paragraphs))
         summary_text = clean_text_or_none(summary_text)
+        self.canary.observe(response.url, 'summary', summary_text)
         if summary_text is None:
             logger.error(f'Missing summary - {response.url}')
             self.failed_urls.add(response.url)
@@ -0,0 +1,29 @@
+import argparse
+
+from lib.snapshot_util import export_snapshot, import_snapshot
+from main import load_config, load_database_connection
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description='Export or import a snapshot of the scraped data'
+    )
+    parser.add_argument(
+        'command', type=str, choices=['export', 'import'],
+        help='whether to export the database or import into it',
+    )
+    parser.add_argument(
+        'snapshot_dir', type=str,
+        help='the snapshot directory path',
+    )
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    with load_database_connection(load_config()) as db_conn:
+        if args.command == 'export':
+            export_snapshot(db_conn, args.snapshot_dir)
+        else:
+            import_snapshot(db_conn, args.snapshot_dir)
+
+if __name__ == '__main__':
+    main()
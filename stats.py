@@ -0,0 +1,27 @@
+import argparse
+
+from lib.book_char_dataset import get_key_str
+from lib.dataset_stats import format_statistics, load_statistics
+from main import SPLIT_KEY_ORDER_FILENAMES, load_config, read_split_char_keys
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description='Report the statistics of an exported dataset file'
+    )
+    parser.add_argument(
+        'filename', type=str, nargs='?', default=None,
+        help='the dataset file, by default the full output of runtime.ini',
+    )
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    filename = args.filename or load_config()['output']['filename']
+    split_keys = {
+        split: list(map(get_key_str, read_split_char_keys(key_filename)))
+        for split, key_filename in SPLIT_KEY_ORDER_FILENAMES.items()
+    }
+    print(format_statistics(load_statistics(filename, split_keys)))
+
+if __name__ == '__main__':
+    main()